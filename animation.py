@@ -0,0 +1,178 @@
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image, GifImagePlugin
+
+import utils
+from compositor import Blender
+
+class AnimationWriter(object):
+    '''
+    Encodes RGB frames to an animated GIF, or to an MP4 (any other
+    extension), one at a time: frames are encoded and written as they come
+    on a background thread, so only up to queue_size frames are in memory.
+    Frames of another size than the first one are resized to it.
+    '''
+
+    def __init__(self, filename, fps=1., loop=0, queue_size=4):
+        self.filename = filename
+        self.fps = fps
+        self.loop = loop
+        self.gif = os.path.splitext(filename)[1].lower() == '.gif'
+        self.size = None
+        self.file = None
+        self.video = None
+        self.count = 0
+        self.error = None
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, frame, block=True):
+        '''
+        frame: HxWx3 np.ndarray, RGB, copied so it can be reused right away
+        block: if False, the frame is dropped (and False returned) when the
+        encoder is behind
+        '''
+        if self.error is not None:
+            raise self.error
+        try:
+            self.frames.put(np.array(frame[:,:,:3]), block)
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.encode(frame)
+                self.count += 1
+            except Exception as e:
+                self.error = e
+        try:
+            self.finish()
+        except Exception as e:
+            self.error = self.error or e
+
+    def encode(self, frame):
+        h, w = frame.shape[:2]
+        if self.size is None:
+            self.size = (w, h)
+            self.open(frame)
+        elif (w, h) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if self.gif:
+            # one palette per frame, in the local color table
+            image = Image.fromarray(frame).quantize(256)
+            for data in GifImagePlugin.getdata(
+                    image, (0, 0), duration=int(round(1000. / self.fps)),
+                    include_color_table=True):
+                self.file.write(data)
+        else:
+            self.video.write(frame[:,:,::-1])
+
+    def open(self, frame):
+        if self.gif:
+            self.file = open(self.filename, 'wb')
+            image = Image.fromarray(frame).quantize(256)
+            header, _ = GifImagePlugin.getheader(
+                image, None, {'loop': self.loop, 'optimize': False})
+            for data in header:
+                self.file.write(data)
+        else:
+            self.video = cv2.VideoWriter(
+                self.filename, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, self.size)
+            if not self.video.isOpened():
+                raise IOError('cannot open {} for writing'.format(self.filename))
+
+    def finish(self):
+        if self.file is not None:
+            self.file.write(b';') # trailer
+            self.file.close()
+        if self.video is not None:
+            self.video.release()
+
+def isolated_frames(bkg, objects, order, buffers=3):
+    '''
+    Yield the background alone, then the background with each object
+    (in order) alone, as HxWx3 frames. Frames are drawn into a ring of
+    buffers canvases, only restoring the region of the previous object, so
+    a frame stays valid until buffers - 1 more frames are yielded.
+    '''
+    height, width = bkg.shape[:2]
+    frame = [0, 0, width, height]
+    blend = Blender()
+    canvases = []
+    dirty = []
+    yield np.ascontiguousarray(bkg[:,:,:3])
+    for i, ind in enumerate(order):
+        k = i % buffers
+        if k == len(canvases):
+            canvases.append(np.array(bkg[:,:,:3]))
+            dirty.append([0, 0, 0, 0])
+        canvas = canvases[k]
+        x, y, w, h = dirty[k]
+        canvas[y : y + h, x : x + w] = bkg[y : y + h, x : x + w, :3]
+        x, y, w, h = region = utils.bbox_intersection(objects[ind].bbox, frame)
+        if w > 0 and h > 0:
+            blend(canvas[y : y + h, x : x + w], objects[ind].crop(region))
+        dirty[k] = region
+        yield canvas
+
+class Prefetcher(object):
+    '''
+    Runs an iterator on a background thread, at most ahead items ahead of
+    the consumer.
+    '''
+
+    def __init__(self, iterable, ahead=1):
+        self.items = queue.Queue(maxsize=ahead)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def run(self, iterable):
+        for item in iterable:
+            if not self.put((True, item)):
+                return
+        self.put((False, None))
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def poll(self):
+        '''
+        Returns (True, item), or (False, None) once the iterator is
+        exhausted. Raises queue.Empty if the next item is not ready yet.
+        '''
+        return self.items.get_nowait()
+
+    def stop(self):
+        self.stopped.set()
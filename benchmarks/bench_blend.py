@@ -0,0 +1,62 @@
+'''
+Micro-benchmark of the blending kernel against the previous float one,
+which also wrote the label mask.
+
+    python benchmarks/bench_blend.py --size 512 --repeat 50
+'''
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compositor import Blender
+
+def blend_float(canvas, mask, image, ind):
+    # kernel used by Application.paste before the fixed point one
+    alpha = image[:,:,3:4].astype(np.float32) / 255
+    region = np.where(image[:,:,3] > 0)
+    canvas[region[0], region[1], :] = \
+        canvas[region[0], region[1], :] * (1 - alpha[region[0], region[1], :]) + \
+        image[region[0], region[1], :3] * alpha[region[0], region[1], :]
+    mask[region[0], region[1]] = ind
+
+def synthetic_object(size, rng):
+    image = rng.randint(0, 256, (size, size, 4)).astype(np.uint8)
+    yy, xx = np.mgrid[:size, :size]
+    dist = np.sqrt((yy - size / 2.) ** 2 + (xx - size / 2.) ** 2) / (size / 2.)
+    # opaque disc with a soft edge, transparent corners
+    image[:,:,3] = (np.clip(1.2 - dist, 0, 0.2) / 0.2 * 255).astype(np.uint8)
+    return image
+
+def timeit(fn, canvas, image, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        c = canvas.copy()
+        t = time.perf_counter()
+        fn(c, image)
+        best = min(best, time.perf_counter() - t)
+    return best, c
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    image = synthetic_object(args.size, rng)
+    canvas = rng.randint(0, 256, (args.size, args.size, 3)).astype(np.uint8)
+    mask = np.zeros((args.size, args.size), dtype=np.int64)
+
+    t_float, c_float = timeit(lambda c, i: blend_float(c, mask, i, 1), canvas, image, args.repeat)
+    t_fixed, c_fixed = timeit(Blender(), canvas, image, args.repeat)
+    diff = np.abs(c_float.astype(np.int16) - c_fixed.astype(np.int16)).max()
+    print('size {0}x{0}: float {1:.2f} ms, fixed {2:.2f} ms, speedup {3:.1f}x, '
+          'max diff {4}'.format(
+              args.size, t_float * 1e3, t_fixed * 1e3, t_float / t_fixed, diff))
+
+if __name__ == "__main__":
+    main()
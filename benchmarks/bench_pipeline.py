@@ -0,0 +1,235 @@
+'''
+Benchmarks of utils and of the compositing pipeline, headless (no Qt).
+
+    python benchmarks/bench_pipeline.py --out baseline.json
+    python benchmarks/bench_pipeline.py --out new.json --baseline baseline.json
+    python benchmarks/bench_pipeline.py --results new.json --baseline baseline.json
+
+Synthetic scenes sweep the image size (--sizes, in megapixels) and the
+number of objects (--objects), and every scene under decomposition/ is run
+as is. Cases:
+
+    crop_padding, resize_with_center, rotate_with_center, mask_to_bbox,
+    compute_center: on one full-frame RGBA object, as the demo used to do
+    paste: blend one object onto the canvas
+    paste_all: full redraw, as on reset and ordering changes
+    manipulate: one frame of a drag (cached transform, then update)
+    manipulate_transform: one frame of resizing and rotating (new warp)
+
+Each case reports the best and the median time of its runs. Results are
+written as JSON. Given a baseline, cases slower than it by more than
+--tolerance are flagged and the exit status is 1.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from glob import glob
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils
+import scene
+from compositor import Compositor
+from layer import Layer, TransformCache
+from bench_blend import synthetic_object
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+UTILS_CASES = ['crop_padding', 'resize_with_center', 'rotate_with_center',
+               'mask_to_bbox', 'compute_center']
+PIPELINE_CASES = ['paste', 'paste_all', 'manipulate', 'manipulate_transform']
+
+def measure(fn, repeat, budget):
+    '''
+    Run fn up to repeat times, or until budget seconds are spent (at least
+    once). Returns (best, median, runs) in seconds.
+    '''
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat:
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+        if time.perf_counter() - start > budget:
+            break
+    return min(times), float(np.median(times)), len(times)
+
+def synthetic_scene(megapixels, count, seed=0):
+    '''
+    4:3 background of noise, and count soft discs with a side of a quarter
+    of the image height, at random places. Objects are bottom first.
+    '''
+    rng = np.random.RandomState(seed)
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+    bkg = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    size = max(height // 4, 8)
+    image = synthetic_object(size, rng)
+    objects = []
+    for _ in range(count):
+        offset = (rng.randint(0, width - size + 1), rng.randint(0, height - size + 1))
+        # same pixels, so that the scene stays small
+        objects.append(Layer(image, offset))
+    return bkg, objects
+
+def full_frame(layer, shape):
+    '''
+    The layer as a full-frame RGBA image, like objects used to be stored.
+    '''
+    x, y, w, h = region = utils.bbox_intersection(layer.bbox, [0, 0, shape[1], shape[0]])
+    image = np.zeros((shape[0], shape[1], 4), dtype=np.uint8)
+    image[y : y + h, x : x + w] = layer.crop(region)
+    return image
+
+def bench_utils(bkg, objects, args):
+    image = full_frame(objects[-1], bkg.shape)
+    center = utils.compute_center(image)
+    height, width = bkg.shape[:2]
+    bbox = [width // 8, height // 8, width * 3 // 4, height * 3 // 4]
+    fns = {
+        'crop_padding': lambda: utils.crop_padding(image, bbox, (0, 0, 0, 0)),
+        'resize_with_center': lambda: utils.resize_with_center(image, center, 1.1),
+        'rotate_with_center': lambda: utils.rotate_with_center(image, center, 10),
+        'mask_to_bbox': lambda: utils.mask_to_bbox(image[:,:,3] > 0),
+        'compute_center': lambda: utils.compute_center(image),
+    }
+    for case in UTILS_CASES:
+        if case in args.cases:
+            yield case, measure(fns[case], args.repeat, args.budget)
+
+def bench_pipeline(bkg, objects, args):
+    height, width = bkg.shape[:2]
+    order = list(range(len(objects)))
+    compositor = Compositor(height, width, args.threads)
+    compositor.paste_all(bkg, objects, order)
+    if 'paste' in args.cases:
+        yield 'paste', measure(lambda: compositor.paste(objects[-1]), args.repeat, args.budget)
+    if 'paste_all' in args.cases:
+        yield 'paste_all', measure(
+            lambda: compositor.paste_all(bkg, objects, order), args.repeat, args.budget)
+
+    # drag the middle object, like Application.renderSnapshot does
+    ind = len(objects) // 2
+    src = objects[ind]
+    layers = list(objects)
+    cache = TransformCache()
+    step = [0]
+    def manipulate(scale, degree):
+        step[0] += 1
+        shift = [(step[0] % 20) * 3, (step[0] % 20) * 2]
+        layers[ind] = cache.transform(src, shift, scale(), degree(), 'bilinear')
+        compositor.update(bkg, layers, order, ind)
+    compositor.paste_all(bkg, layers, order)
+    compositor.grab(bkg, layers, order, ind)
+    if 'manipulate' in args.cases:
+        yield 'manipulate', measure(
+            lambda: manipulate(lambda: 1.2, lambda: 15.), args.repeat, args.budget)
+    if 'manipulate_transform' in args.cases:
+        # a new scale and angle every frame, so the transform cache misses
+        yield 'manipulate_transform', measure(
+            lambda: manipulate(lambda: 1. + step[0] * 1e-3, lambda: step[0] * 0.5),
+            args.repeat, args.budget)
+
+def run_scene(name, bkg, objects, args, with_utils):
+    megapixels = round(bkg.shape[0] * bkg.shape[1] / 1e6, 2)
+    benches = [bench_pipeline(bkg, objects, args)]
+    if with_utils:
+        benches.insert(0, bench_utils(bkg, objects, args))
+    for bench in benches:
+        for case, (best, median, runs) in bench:
+            # utils run on a single object
+            count = 1 if case in UTILS_CASES else len(objects)
+            result = {'case': case, 'scene': name, 'megapixels': megapixels,
+                      'objects': count, 'best': best, 'median': median, 'runs': runs}
+            print('{:<22} {:<12} {:>6.2f} MP {:>3} objects  best {:>9.3f} ms  '
+                  'median {:>9.3f} ms'.format(
+                      case, name, megapixels, count, best * 1e3, median * 1e3))
+            sys.stdout.flush()
+            yield result
+
+def run(args):
+    results = []
+    for megapixels in args.sizes:
+        for i, count in enumerate(args.objects):
+            bkg, objects = synthetic_scene(megapixels, count)
+            # utils only depend on the image size
+            results += run_scene('synthetic', bkg, objects, args, with_utils=i == 0)
+    if not args.no_scenes:
+        file_dirs = sorted(d for d in glob(os.path.join(ROOT, 'decomposition', '*'))
+                           if os.path.isdir(d))
+        for file_dir in file_dirs:
+            bkg, objects = scene.load_scene(file_dir)
+            results += run_scene(os.path.basename(file_dir), bkg, objects, args, with_utils=True)
+    return {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'platform': platform.platform(), 'python': platform.python_version(),
+                     'numpy': np.__version__, 'cv2': cv2.__version__,
+                     'cpu_count': os.cpu_count(), 'threads': args.threads},
+            'results': results}
+
+def result_key(result):
+    return (result['case'], result['scene'], result['megapixels'], result['objects'])
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the speed of results relative to baseline, returns the number of
+    regressions, i.e. cases slower by more than tolerance (a fraction).
+    '''
+    base = {result_key(r): r for r in baseline['results']}
+    regressions = 0
+    for r in results['results']:
+        b = base.get(result_key(r))
+        if b is None:
+            continue
+        ratio = r['best'] / max(b['best'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 / (1 + tolerance):
+            flag = 'faster'
+        print('{:<22} {:<12} {:>6.2f} MP {:>3} objects  {:>9.3f} -> {:>9.3f} ms  '
+              '{:>5.2f}x  {}'.format(r['case'], r['scene'], r['megapixels'], r['objects'],
+                                     b['best'] * 1e3, r['best'] * 1e3, ratio, flag))
+    print('{} regressions over {:.0f}%'.format(regressions, tolerance * 100))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark utils and the compositing pipeline.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.3, 1, 4, 12, 24],
+                        help='synthetic image sizes, in megapixels')
+    parser.add_argument('--objects', type=int, nargs='+', default=[1, 5, 15, 50],
+                        help='synthetic object counts')
+    parser.add_argument('--cases', nargs='+', default=UTILS_CASES + PIPELINE_CASES,
+                        choices=UTILS_CASES + PIPELINE_CASES)
+    parser.add_argument('--no-scenes', action='store_true', help='skip decomposition/ scenes')
+    parser.add_argument('--threads', type=int, default=1, help='compositing threads')
+    parser.add_argument('--repeat', type=int, default=20, help='maximum runs per case')
+    parser.add_argument('--budget', type=float, default=2., help='seconds per case')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--results', help='compare these results instead of running')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown flagged as a regression, e.g. 0.2 for 20%%')
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results, 'r') as f:
+            results = json.load(f)
+    else:
+        cv2.setNumThreads(args.threads)
+        results = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+'''
+Load generator for serve.py: concurrent keep-alive clients sending random
+recomposition specs, then the latency and throughput seen by the clients
+and reported by the service.
+
+    python serve.py --workers 4 &
+    python benchmarks/bench_serve.py --concurrency 16 --requests 500
+    python benchmarks/bench_serve.py --unix /tmp/deocc.sock --format rgba
+
+--distinct bounds the number of different specs, so that resized and
+rotated objects get reused from the transform cache as in real traffic.
+'''
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+class Client(object):
+    '''
+    One keep-alive HTTP/1.1 connection.
+    '''
+
+    def __init__(self, host, port, unix=None):
+        self.host = host
+        self.port = port
+        self.unix = unix
+        self.reader = self.writer = None
+
+    async def connect(self):
+        if self.unix:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, target, body=b''):
+        if self.writer is None:
+            await self.connect()
+        head = '{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            method, target, self.host, len(body))
+        self.writer.write(head.encode('latin-1') + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        return status, headers, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def random_spec(rng, name, count):
+    objects = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            objects.append(None)
+            continue
+        objects.append({'shift': [rng.randint(-50, 50), rng.randint(-50, 50)],
+                        'scale': round(rng.uniform(0.8, 1.2), 2),
+                        'degree': rng.randint(-30, 30)})
+    order = list(range(count))
+    rng.shuffle(order)
+    return {'scene': name, 'objects': objects, 'order': order}
+
+async def worker(client, specs, counter, target, latencies, errors):
+    while counter[0] > 0:
+        counter[0] -= 1
+        body = json.dumps(random.choice(specs)).encode('utf-8')
+        start = time.perf_counter()
+        status, _, payload = await client.request('POST', target, body)
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(payload.decode('utf-8', 'replace'))
+    client.close()
+
+async def run(args):
+    client = Client(args.host, args.port, args.unix)
+    _, _, body = await client.request('GET', '/scenes')
+    client.close()
+    scenes = json.loads(body.decode('utf-8'))
+    if args.scenes:
+        scenes = {name: scenes[name] for name in args.scenes}
+    rng = random.Random(args.seed)
+    specs = [random_spec(rng, name, scenes[name]['objects'])
+             for name in sorted(scenes) for _ in range(args.distinct)]
+
+    target = '/render?format={}'.format(args.format)
+    clients = [Client(args.host, args.port, args.unix) for _ in range(args.concurrency)]
+    for c in clients:
+        await c.connect()
+    counter = [args.requests]
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(c, specs, counter, target, latencies, errors)
+                           for c in clients])
+    elapsed = time.perf_counter() - start
+
+    p50, p99 = np.percentile(np.array(latencies), [50, 99]) * 1e3
+    print('{} requests over {} connections in {:.2f}s: {:.1f} req/s, '
+          'p50 {:.1f} ms, p99 {:.1f} ms, {} errors'.format(
+              len(latencies), args.concurrency, elapsed, len(latencies) / elapsed,
+              p50, p99, len(errors)))
+    if errors:
+        print('first error: {}'.format(errors[0]))
+    client = Client(args.host, args.port, args.unix)
+    _, _, body = await client.request('GET', '/stats')
+    client.close()
+    print('service: {}'.format(body.decode('utf-8')))
+    return 1 if errors else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test serve.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--unix', help='connect to this Unix socket instead')
+    parser.add_argument('--scenes', nargs='+', help='scene names, every resident one by default')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--distinct', type=int, default=8, help='different specs per scene')
+    parser.add_argument('--format', default='png', choices=['png', 'rgba'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
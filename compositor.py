@@ -0,0 +1,254 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import utils
+from profiling import profiler
+from layer import Layer, LayerIndex
+from labels import LabelMap
+
+class Blender(object):
+    '''
+    Alpha blending in uint16 fixed point, on contiguous slices and into
+    preallocated scratch buffers, which only grow with the largest region.
+    '''
+
+    def __init__(self):
+        self.scratch = np.zeros((3, 0), dtype=np.uint16)
+
+    def buffers(self, h, w):
+        if self.scratch.shape[1] < h * w * 3:
+            self.scratch = np.zeros((3, h * w * 3), dtype=np.uint16)
+        return (self.scratch[0, : h * w * 3].reshape(h, w, 3),
+                self.scratch[1, : h * w * 3].reshape(h, w, 3),
+                self.scratch[2, : h * w].reshape(h, w, 1))
+
+    def __call__(self, canvas, image):
+        '''
+        Blend image (hxwx4) onto canvas (hxwx3) in place.
+        '''
+        h, w = image.shape[:2]
+        alpha = image[:,:,3:4]
+        src, dst, inv_alpha = self.buffers(h, w)
+        # (src * a + dst * (255 - a) + 128) / 255, rounded
+        np.multiply(image[:,:,:3], alpha, out=src, dtype=np.uint16)
+        np.subtract(255, alpha, out=inv_alpha, dtype=np.uint16)
+        np.multiply(canvas, inv_alpha, out=dst)
+        src += dst
+        src += 128
+        np.right_shift(src, 8, out=dst)
+        src += dst
+        src >>= 8
+        canvas[...] = src
+
+# thread pools shared by compositors, by number of threads
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(threads):
+    with _executors_lock:
+        if threads not in _executors:
+            _executors[threads] = ThreadPoolExecutor(max_workers=threads)
+        return _executors[threads]
+
+class Compositor(object):
+    '''
+    Blends the background and the object layers onto a canvas.
+    The geometry of the objects is kept in self.index, so that when one
+    object changes, only the union of its old and new bbox is re-blended,
+    and only with the layers that overlap it. When only the order changes,
+    only where layers that swapped overlap is re-blended.
+    While an object is grabbed, the layers below and above it are cached as
+    two pre-composited buffers, so a frame blends three layers at most.
+    Which object is where is left to self.labels, updated lazily.
+    Redraws are split into tiles of tile x tile pixels, composited in
+    parallel if threads > 1 (cv2 and numpy release the GIL). Tiles only
+    blend the layers overlapping them, and scratch memory is bounded by the
+    tile size times the number of threads.
+    '''
+
+    def __init__(self, height, width, threads=1, tile=256):
+        self.height = height
+        self.width = width
+        self.frame = [0, 0, width, height]
+        self.canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        self.labels = LabelMap(height, width)
+        self.index = LayerIndex()
+        self.order = []
+        self.stack = None
+        self.tile = tile
+        self.executor = get_executor(threads) if threads > 1 else None
+        # one blender, with its scratch buffers, per thread
+        self.blenders = threading.local()
+
+    def blend(self, canvas, image):
+        blender = getattr(self.blenders, 'blender', None)
+        if blender is None:
+            blender = self.blenders.blender = Blender()
+        blender(canvas, image)
+
+    def tiles(self, region):
+        x, y, w, h = region
+        t = self.tile
+        return [utils.bbox_intersection([tx, ty, t, t], region)
+                for ty in range(y - y % t, y + h, t)
+                for tx in range(x - x % t, x + w, t)]
+
+    def render_region(self, canvas, bkg, objects, order, region):
+        '''
+        Blend bkg and objects (in order) onto canvas within region, by tiles.
+        '''
+        tiles = self.tiles(region)
+        with profiler.span('render_region', tiles=len(tiles)):
+            if len(tiles) == 1:
+                jobs = [(tiles[0], order)]
+            else:
+                # the layers overlapping each tile, in order, in one batch
+                hits = utils.bbox_overlap_matrix(tiles, [objects[i].bbox for i in order])
+                jobs = [(tile, [order[k] for k in np.flatnonzero(hit)])
+                        for tile, hit in zip(tiles, hits)]
+            if self.executor is None or len(jobs) == 1:
+                for tile, layers in jobs:
+                    self.render_tile(canvas, bkg, objects, layers, tile)
+            else:
+                for _ in self.executor.map(
+                        lambda job: self.render_tile(canvas, bkg, objects, job[1], job[0]), jobs):
+                    pass
+
+    def render_tile(self, canvas, bkg, objects, order, tile):
+        with profiler.span('render_tile'):
+            x, y, w, h = tile
+            canvas[y : y + h, x : x + w] = bkg[y : y + h, x : x + w, :3]
+            for i in order:
+                x, y, w, h = region = utils.bbox_intersection(objects[i].bbox, tile)
+                if w > 0 and h > 0:
+                    self.blend(canvas[y : y + h, x : x + w], objects[i].crop(region))
+
+    def paste(self, image, region=None):
+        '''
+        image: HxWx3 np.ndarray (background) or Layer (object)
+        region: (x,y,w,h), whole canvas if None
+        '''
+        if region is None:
+            region = self.frame
+        if isinstance(image, Layer):
+            x, y, w, h = region = utils.bbox_intersection(
+                utils.bbox_intersection(image.bbox, self.frame), region)
+            if w == 0 or h == 0:
+                return
+            self.blend(self.canvas[y : y + h, x : x + w], image.crop(region))
+        else:
+            x, y, w, h = region
+            self.canvas[y : y + h, x : x + w] = image[y : y + h, x : x + w, :3]
+
+    def paste_all(self, bkg, objects, order):
+        '''
+        Full redraw, used on reset and ordering changes.
+        '''
+        with profiler.span('paste_all'):
+            self.invalidate()
+            self.index = LayerIndex(objects)
+            self.order = list(order)
+            self.labels.update(objects, order, self.index)
+            self.render_region(self.canvas, bkg, objects, order, self.frame)
+
+    def reorder(self, bkg, objects, order):
+        '''
+        Re-blend after only the order of objects changed, returns the
+        re-blended region (x,y,w,h) or None.
+        '''
+        with profiler.span('reorder'):
+            if len(self.index) != len(objects) or sorted(self.order) != sorted(order):
+                self.paste_all(bkg, objects, order)
+                return self.frame
+            self.invalidate()
+            n = len(order)
+            old_rank = np.empty(n, dtype=np.int64)
+            old_rank[self.order] = np.arange(n)
+            new_rank = np.empty(n, dtype=np.int64)
+            new_rank[list(order)] = np.arange(n)
+            self.order = list(order)
+            self.labels.update(objects, order, self.index)
+            # pairs of overlapping objects that are now the other way round
+            swapped = (old_rank[:, None] < old_rank[None]) != (new_rank[:, None] < new_rank[None])
+            overlaps = utils.bbox_overlap_matrix(self.index.bboxes, self.index.bboxes)
+            dirty = [0, 0, 0, 0]
+            for i, j in np.argwhere(np.triu(swapped & overlaps, 1)):
+                dirty = utils.bbox_union(dirty, utils.bbox_intersection(
+                    self.index.bboxes[i].tolist(), self.index.bboxes[j].tolist()))
+            dirty = utils.bbox_intersection(dirty, self.frame)
+            if dirty[2] <= 0 or dirty[3] <= 0:
+                return None
+            self.render_region(self.canvas, bkg, objects, order, dirty)
+            return dirty
+
+    def update(self, bkg, objects, order, ind):
+        '''
+        Re-blend after objects[ind] changed, returns the re-blended region
+        (x,y,w,h) or None.
+        '''
+        with profiler.span('update', ind=int(ind)):
+            if len(self.index) != len(objects):
+                self.index = LayerIndex(objects)
+            old_bbox = self.index.bboxes[ind].tolist()
+            new_bbox = objects[ind].bbox
+            self.index.update(ind, objects[ind])
+            self.order = list(order)
+            self.labels.update(objects, order, self.index)
+            if self.stack is not None and self.stack['ind'] != ind:
+                # the layers cached below or above the grabbed object changed
+                self.invalidate()
+            dirty = utils.bbox_intersection(utils.bbox_union(old_bbox, new_bbox), self.frame)
+            if dirty[2] <= 0 or dirty[3] <= 0:
+                return None
+            if self.stack is not None and self.stack['ind'] == ind:
+                self.paste_stack(objects[ind], dirty)
+                return dirty
+            self.render_region(self.canvas, bkg, objects, order, dirty)
+            return dirty
+
+    def grab(self, bkg, objects, order, ind):
+        '''
+        Cache the layers below objects[ind] (blended onto the background) and
+        the layers above it (premultiplied RGBA).
+        '''
+        with profiler.span('grab', ind=int(ind)):
+            pos = list(order).index(ind)
+            below = np.empty_like(self.canvas)
+            self.render_region(below, bkg, objects, order[:pos], self.frame)
+            above = np.zeros((self.height, self.width, 3), dtype=np.float32)
+            above_alpha = np.zeros((self.height, self.width, 1), dtype=np.float32)
+            above_bbox = [0, 0, 0, 0]
+            for i in order[pos + 1:]:
+                x, y, w, h = region = utils.bbox_intersection(objects[i].bbox, self.frame)
+                if w == 0 or h == 0:
+                    continue
+                image = objects[i].crop(region)
+                alpha = image[:,:,3:4].astype(np.float32) / 255
+                above[y : y + h, x : x + w] *= 1 - alpha
+                above[y : y + h, x : x + w] += image[:,:,:3] * alpha
+                above_alpha[y : y + h, x : x + w] *= 1 - alpha
+                above_alpha[y : y + h, x : x + w] += alpha
+                above_bbox = utils.bbox_union(above_bbox, region)
+            self.stack = {'ind': ind, 'below': below, 'above': above,
+                          'above_alpha': above_alpha, 'above_bbox': above_bbox}
+
+    def invalidate(self):
+        self.stack = None
+
+    def paste_stack(self, image, region):
+        '''
+        Blend below + image + above within region (x,y,w,h).
+        '''
+        with profiler.span('paste_stack'):
+            stack = self.stack
+            x, y, w, h = region
+            self.canvas[y : y + h, x : x + w] = stack['below'][y : y + h, x : x + w]
+            self.paste(image, region)
+            x, y, w, h = utils.bbox_intersection(stack['above_bbox'], region)
+            if w <= 0 or h <= 0:
+                return
+            canvas = self.canvas[y : y + h, x : x + w]
+            canvas[...] = canvas * (1 - stack['above_alpha'][y : y + h, x : x + w]) + \
+                stack['above'][y : y + h, x : x + w]
@@ -1,22 +1,189 @@
-import numpy as np
-from PyQt5.QtWidgets import (QAction, QLabel, QWidget, QVBoxLayout, QHBoxLayout, QMenu, QPushButton, QGridLayout, QApplication)
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import (QImage, QPixmap)
-from PyQt5.QtTest import QTest
+import os
+import math
+import queue
+import threading
 
-import utils
+from PyQt5.QtWidgets import (QAction, QWidget, QVBoxLayout, QHBoxLayout, QMenu, QPushButton, QGridLayout, QApplication)
+from PyQt5.QtCore import (Qt, QThread, QTimer, QRect, QRectF, pyqtSignal)
+from PyQt5.QtGui import (QImage, QPainter)
 
-import time
+# the pipeline (numpy, cv2) is imported where first needed, so that the
+# window shows up before it is loaded
+from state import SceneState
+from profiling import profiler
+
+class RenderWorker(QThread):
+    '''
+    Calls render(snapshot) off the UI thread. Requests are coalesced: only
+    the newest one that is pending when the worker gets free is rendered.
+    '''
+
+    frameReady = pyqtSignal()
+
+    def __init__(self, render, parent=None):
+        super().__init__(parent)
+        self.render = render
+        self.cond = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.running = True
+
+    def request(self, snapshot):
+        with self.cond:
+            self.pending = snapshot
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.pending = None
+
+    def wait_idle(self):
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.wait()
+
+    def run(self):
+        profiler.name_thread('RenderWorker')
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                snapshot, self.pending = self.pending, None
+                self.busy = True
+            try:
+                self.render(snapshot)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+            self.frameReady.emit()
+
+class CanvasView(QWidget):
+    '''
+    Shows an RGB np.ndarray scaled to the widget, and repaints only the
+    regions that changed. Frames are published, from any thread, into a
+    copy of the buffer that the view paints from, so painting only waits
+    for that copy, never for compositing.
+    '''
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.lock = threading.Lock()
+        self.buffer = None # last published buffer
+        self.front = None # copy of it, painted from
+        self.image = QImage()
+        self.scale = 1. # widget pixels per buffer pixel
+        self.pending = None # region to repaint, in buffer pixels
+
+    def publish(self, buffer, scale, region=None):
+        '''
+        Copy region (x,y,w,h) of buffer, or all of it if buffer or scale
+        changed, to be repainted by present(). buffer must not be drawn to
+        meanwhile.
+        '''
+        with self.lock:
+            h, w = buffer.shape[:2]
+            if buffer is not self.buffer or scale != self.scale:
+                if self.front is None or self.front.shape != buffer.shape:
+                    self.front = buffer.copy()
+                    # the QImage does not own the pixels, self.front keeps them alive
+                    self.image = QImage(self.front.data, w, h, 3 * w, QImage.Format_RGB888)
+                else:
+                    self.front[...] = buffer
+                self.buffer = buffer
+                self.scale = scale
+                region = [0, 0, w, h]
+            elif region is None:
+                return
+            else:
+                x, y, rw, rh = region
+                self.front[y : y + rh, x : x + rw] = buffer[y : y + rh, x : x + rw]
+            if self.pending is not None:
+                x1 = min(self.pending[0], region[0])
+                y1 = min(self.pending[1], region[1])
+                x2 = max(self.pending[0] + self.pending[2], region[0] + region[2])
+                y2 = max(self.pending[1] + self.pending[3], region[1] + region[3])
+                region = [x1, y1, x2 - x1, y2 - y1]
+            self.pending = region
+
+    def present(self):
+        '''
+        Repaint what was published since the last call, on the UI thread.
+        '''
+        with self.lock:
+            region, self.pending = self.pending, None
+        if region is None:
+            return
+        x, y, w, h = region
+        s = self.scale
+        self.update(QRect(int(x * s) - 1, int(y * s) - 1,
+                          int(math.ceil(w * s)) + 3, int(math.ceil(h * s)) + 3))
+
+    def paintEvent(self, event):
+        rect = event.rect()
+        with self.lock:
+            if self.image.isNull():
+                return
+            s = self.scale
+            # buffer pixels under the exposed rect
+            x1 = max(int(rect.left() / s), 0)
+            y1 = max(int(rect.top() / s), 0)
+            x2 = min(int(math.ceil((rect.right() + 1) / s)), self.image.width())
+            y2 = min(int(math.ceil((rect.bottom() + 1) / s)), self.image.height())
+            if x2 <= x1 or y2 <= y1:
+                return
+            with profiler.span('paint'):
+                painter = QPainter(self)
+                painter.drawImage(QRectF(x1 * s, y1 * s, (x2 - x1) * s, (y2 - y1) * s),
+                                  self.image, QRectF(x1, y1, x2 - x1, y2 - y1))
+                painter.end()
 
 class Application(QWidget):
 
+    # filename, error message or '' once a background save is done
+    saved = pyqtSignal(str, str)
+
     def __init__(self, parent, dims, debug=False):
         super().__init__(parent)
         swidth, sheight = dims
         self.main_width, self.main_height = swidth * 0.9, sheight * 0.9
         self.debug = debug
-
-        self.imageLabel = QLabel(self)
+        # resampling used while dragging and when saving
+        self.interpolation = 'bilinear'
+        self.export_interpolation = 'bicubic'
+        # PNG compression level of saves, 0 (fastest) to 9 (smallest)
+        self.compression = 3
+        # threads of background saves, see background()
+        self.saving = []
+        # resized and rotated objects, so that dragging them only moves pixels
+        self.transform_cache = None # created by init_components
+        # threads compositing the tiles of a redraw
+        self.threads = os.cpu_count()
+        # images larger than this (longest side) are dragged at a lower resolution
+        self.preview_size = 1024
+        self.preview = None
+        # object last rendered at preview resolution, and object to refine
+        self.previewing = None
+        self.refine_ind = None
+        # transforms and order of the objects, see state.py
+        self.state = None
+        self.this_obj = 0
+        # transform of the dragged object when the drag started
+        self.drag_start = None
+        # frames of "Show Objects" rendered ahead, see paste_isolated()
+        self.isolated = None
+        # animation.AnimationWriter of the shown frames, while recording
+        self.recorder = None
+
+        self.canvasView = None
 
         # buttons
         btnsWidth = 120
@@ -47,96 +214,355 @@ class Application(QWidget):
         self.btnGrid.addWidget(self.saveasBtn, 5, 0, Qt.AlignRight)
 
         picLayout = QHBoxLayout()
-        picLayout.addWidget(self.imageLabel, Qt.AlignCenter)
+        # rendering of manipulations, see renderSnapshot()
+        self.render_lock = threading.RLock()
+
+        self.canvasView = CanvasView(self)
+        picLayout.addWidget(self.canvasView, Qt.AlignCenter)
         picLayout.addLayout(self.btnGrid, Qt.AlignLeft)
         self.setLayout(picLayout)
-        self.imageLabel.mousePressEvent = self.mousePressEventPic
-        self.imageLabel.mouseMoveEvent = self.mouseMoveEventPic
-        self.imageLabel.mouseReleaseEvent = self.mouseReleaseEventPic
-        self.imageLabel.contextMenuEvent = self.contextMenuEventPic
+        self.canvasView.mousePressEvent = self.mousePressEventPic
+        self.canvasView.mouseMoveEvent = self.mouseMoveEventPic
+        self.canvasView.mouseReleaseEvent = self.mouseReleaseEventPic
+        self.canvasView.contextMenuEvent = self.contextMenuEventPic
 
-        #self.imageLabel.setMouseTracking(True)
+        #self.canvasView.setMouseTracking(True)
 
         # 
         self.canvas = None
-        self.mask = None
         self.canvas_show = QImage()
+        # region of the shown buffer changed since the last showCanvas
+        self.dirty = None
 
         # status
         self.deocc_flag = False
 
+        self.worker = RenderWorker(self.renderSnapshot, self)
+        self.worker.frameReady.connect(self.showCanvas)
+        self.worker.start()
+        # full resolution render once arrow keys are released
+        self.refineTimer = QTimer(self)
+        self.refineTimer.setSingleShot(True)
+        self.refineTimer.setInterval(300)
+        self.refineTimer.timeout.connect(self.refine)
+        self.showTimer = QTimer(self)
+        self.showTimer.setInterval(1000)
+        self.showTimer.timeout.connect(self.showNext)
+
     def init_image(self, image_ori):
         self.deocc_flag = False
         self.image_ori = image_ori
         self.image_height = self.image_ori.shape[0]
         self.image_width = self.image_ori.shape[1]
-        self.canvas = self.image_ori.copy()
-        self.mask = np.zeros((self.image_height, self.image_width), dtype=np.int)
+        self.stopShow()
+        from compositor import Compositor
+        self.worker.cancel()
+        with self.render_lock:
+            self.compositor = Compositor(self.image_height, self.image_width, self.threads)
+            self.compositor.paste(self.image_ori)
+            self.canvas = self.compositor.canvas
+            self.preview = None
+            self.previewing = None
+            self.refine_ind = None
+            self.dirty = None
+            # bound to the canvas, for saving
+            self.canvas_show = QImage(
+                self.canvas.data, self.image_width, self.image_height,
+                3 * self.image_width, QImage.Format_RGB888)
+        # scale the image down to the window, small images are shown 1:1
+        self.ratio = min(1., self.main_width / self.image_width,
+                         self.main_height / self.image_height)
+        self.pixmap_scope = (int(self.image_width * self.ratio),
+                             int(self.image_height * self.ratio))
+        self.canvasView.setFixedSize(*self.pixmap_scope)
         self.showCanvas()
         QApplication.setOverrideCursor(Qt.ArrowCursor)
 
     def reset(self):
-        self.objects = [o.copy() for o in self.objects_ori]
-        self.shift = [[0, 0] for o in self.objects_ori]
-        self.scale = [1. for o in self.objects_ori]
-        self.degree = [0. for o in self.objects_ori]
-        self.center = [utils.compute_center(o) for o in self.objects_ori]
-        self.order = np.arange(len(self.objects))
+        if not self.deocc_flag:
+            return
+        self.state.reset()
+        self.sync()
+
+    def undo(self):
+        if self.deocc_flag and self.state.undo():
+            self.sync()
+
+    def redo(self):
+        if self.deocc_flag and self.state.redo():
+            self.sync()
+
+    def sync(self):
+        '''
+        Derive the rendered layers from self.state, then redraw.
+        '''
+        self.worker.cancel()
+        self.worker.wait_idle()
+        self.refine_ind = None
+        self.drag_start = None
+        with self.render_lock:
+            if self.this_obj > len(self.state):
+                self.this_obj = 0
+            # layers are immutable and transforms are cached, so this is cheap
+            self.objects = [self.transformObject(self.snapshot(i), self.interpolation)
+                            for i in range(len(self.state))]
+            if self.preview is not None:
+                self.preview['objects'] = [
+                    self.transformObject(self.snapshot(i), self.interpolation,
+                                         self.preview_source(self.state.sources[i]),
+                                         self.preview['factor'])
+                    for i in range(len(self.state))]
         self.paste_all()
 
     def paste_isolated(self):
-        self.paste(self.bkg)
-        QTest.qWait(1000)
-        for i in range(len(self.objects)):
-            ind = self.order[i]
-            self.paste(self.bkg)
-            self.paste(self.objects[ind], ind + 1)
-            self.showCanvas()
-            QTest.qWait(1000)
-        self.paste_all()
+        '''
+        Show the background, then every object alone on it, one per second.
+        The frames are rendered ahead on a thread and shown by showTimer,
+        the canvas is left untouched.
+        '''
+        if not self.deocc_flag:
+            return
+        import animation
+        self.flush(show=False)
+        self.isolated = animation.Prefetcher(animation.isolated_frames(
+            self.bkg, list(self.objects), self.state.order))
+        self.showTimer.start()
+        self.showNext()
+
+    def showNext(self):
+        if self.isolated is None:
+            return
+        try:
+            more, frame = self.isolated.poll()
+        except queue.Empty:
+            # not rendered yet, shown on the next tick
+            return
+        if not more:
+            self.stopShow()
+            return
+        self.canvasView.publish(frame, self.ratio)
+        self.canvasView.present()
+        self.recordFrame(frame)
+
+    def stopShow(self):
+        if self.isolated is None:
+            return
+        self.showTimer.stop()
+        self.isolated.stop()
+        self.isolated = None
+        self.showCanvas()
+
+    def exportObjects(self, filename, fps=1.):
+        '''
+        Encode the frames of paste_isolated to filename (.gif or .mp4) in the
+        background, frame by frame.
+        '''
+        if not self.deocc_flag:
+            return
+        import animation
+        self.flush(show=False)
+        frames = animation.isolated_frames(self.bkg, list(self.objects), self.state.order)
+        def export():
+            with animation.AnimationWriter(filename, fps) as writer:
+                for frame in frames:
+                    writer.write(frame)
+        self.background(filename, export)
+
+    def exportAll(self, out_dir):
+        '''
+        Write the background, the transformed objects and the composite to
+        out_dir in the background, see scene.export_scene.
+        '''
+        if not self.deocc_flag:
+            return
+        import scene
+        self.flush(show=False)
+        with self.render_lock:
+            canvas = self.canvas.copy()
+        snapshots = [self.snapshot(i) for i in range(len(self.state))]
+        order = self.state.order
+        def export():
+            objects = list(scene.get_executor().map(
+                lambda s: self.transformObject(s, self.export_interpolation), snapshots))
+            scene.export_scene(out_dir, self.bkg, objects, order, canvas, self.compression)
+        self.background(out_dir, export)
+
+    def saveCanvas(self, filename):
+        self.flush()
+        png = os.path.splitext(filename)[1].lower() == '.png'
+        with self.render_lock:
+            image = self.canvas.copy() if png else self.canvas_show.copy()
+        if png:
+            import scene
+            self.background(filename, scene.write_png, filename, image, self.compression)
+            return
+        # other formats Qt can write
+        def save():
+            if not image.save(filename, None):
+                raise IOError('cannot write {}'.format(filename))
+        self.background(filename, save)
+
+    def saveObject(self, filename, image):
+        import scene
+        self.background(filename, scene.write_png, filename, image, self.compression)
+
+    def background(self, filename, fn, *args):
+        '''
+        Run fn(*args) on a thread, then emit saved(filename, error or '').
+        '''
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                self.saved.emit(filename, str(e) or type(e).__name__)
+                return
+            self.saved.emit(filename, '')
+        self.saving = [t for t in self.saving if t.is_alive()]
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.saving.append(thread)
+
+    def waitSaved(self):
+        for thread in self.saving:
+            thread.join()
+        self.saving = []
+
+    def startRecording(self, filename, fps=25.):
+        '''
+        Encode every frame shown from now on (drags included) to filename.
+        '''
+        import animation
+        self.stopRecording()
+        self.recorder = animation.AnimationWriter(filename, fps)
+        with self.render_lock:
+            if self.canvasView.buffer is not None:
+                self.recordFrame(self.canvasView.buffer)
+
+    def stopRecording(self):
+        '''
+        Returns the number of frames recorded, None if not recording or if
+        encoding failed, which is then reported through saved.
+        '''
+        with self.render_lock:
+            recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return None
+        try:
+            return recorder.close()
+        except Exception as e:
+            self.saved.emit(recorder.filename, str(e) or type(e).__name__)
+            return None
+
+    def recordFrame(self, buffer):
+        with self.render_lock:
+            recorder = self.recorder
+            if recorder is None:
+                return
+            try:
+                # frames are dropped if the encoder is behind
+                recorder.write(buffer, block=False)
+                return
+            except Exception:
+                # e.g. an unwritable file, stop instead of failing every frame
+                pass
+        self.stopRecording()
 
     def init_components(self, bkg, objs):
         self.bkg = bkg
-        self.objects_ori = objs
         self.deocc_flag = True
         QApplication.setOverrideCursor(Qt.WaitCursor)
-        QTest.qWait(500)
-        self.reset()
+        self.worker.cancel()
+        self.worker.wait_idle()
+        with self.render_lock:
+            self.state = SceneState(objs)
+            self.this_obj = 0
+            if self.transform_cache is None:
+                from layer import TransformCache
+                self.transform_cache = TransformCache(budget=256 << 20)
+            self.transform_cache.clear()
+            self.init_preview()
+        self.sync()
         QApplication.setOverrideCursor(Qt.OpenHandCursor)
 
-    def pad(self, obj):
-        h, w = obj.shape[:2]
-        obj_canvas = np.zeros((self.image_height, self.image_width, 4), dtype=np.uint8)
-        offy = (self.image_height - h) // 2
-        offx = (self.image_width - w) // 2
-        obj_canvas[offy : offy + h, offx : offx + w, :] = obj
-        return obj_canvas
-
     def insert_object(self, obj):
         if not self.deocc_flag:
             return
-        obj = self.pad(obj)
-        self.objects_ori.append(obj)
-        self.objects.append(obj.copy())
-        self.shift.append([0, 0])
-        self.scale.append(1.)
-        self.degree.append(0.)
-        self.center.append(utils.compute_center(obj))
-        self.order = np.array(self.order.tolist() + [len(self.objects) - 1])
-        self.paste_all()
+        from layer import Layer
+        obj = Layer.centered(obj, (self.image_height, self.image_width))
+        self.flush(show=False)
+        with self.render_lock:
+            self.state.insert(obj)
+        self.sync()
 
     def paste_all(self):
-        self.paste(self.bkg, 0)
-        for i in range(len(self.objects)):
-            ind = self.order[i]
-            self.paste(self.objects[ind], ind + 1) # ind=0 is background
+        self.flush(show=False)
+        with self.render_lock:
+            order = self.state.order
+            self.compositor.paste_all(self.bkg, self.objects, order)
+            if self.preview is not None:
+                self.preview['compositor'].paste_all(
+                    self.preview['bkg'], self.preview['objects'], order)
+            self.previewing = None
+            self.dirty = self.compositor.frame
         self.showCanvas()
 
+    def init_preview(self):
+        '''
+        Halve the background and objects until they fit in preview_size.
+        '''
+        self.preview = None
+        levels = 0
+        while max(self.image_height, self.image_width) > self.preview_size * 2 ** levels:
+            levels += 1
+        if levels == 0:
+            return
+        import utils
+        from compositor import Compositor
+        bkg = self.bkg
+        for _ in range(levels):
+            bkg = utils.pyr_down(bkg)
+        self.preview = {
+            'levels': levels, 'factor': 1. / 2 ** levels, 'bkg': bkg,
+            'compositor': Compositor(bkg.shape[0], bkg.shape[1], self.threads),
+            'sources': {}, 'objects': []}
+
+    def preview_source(self, src):
+        '''
+        src downsampled to the preview, computed once per source layer.
+        '''
+        entry = self.preview['sources'].get(id(src))
+        if entry is None:
+            small = src
+            for _ in range(self.preview['levels']):
+                small = small.half()
+            # the entry keeps src alive, so its id is not reused meanwhile
+            entry = self.preview['sources'][id(src)] = (src, small)
+        return entry[1]
+
+    def flush(self, show=True):
+        '''
+        Wait for pending manipulations to be rendered at full resolution.
+        '''
+        self.stopShow()
+        self.refine()
+        self.worker.wait_idle()
+        if show:
+            self.showCanvas()
+
+    def refine(self):
+        self.refineTimer.stop()
+        if self.refine_ind is not None:
+            self.worker.request(self.snapshot(self.refine_ind))
+            self.refine_ind = None
+
     def getObject(self, coord):
         x, y = coord
         x /= self.ratio
         y /= self.ratio
-        return self.mask[int(y), int(x)]
+        # objects are only up to date at full resolution
+        self.flush()
+        with self.render_lock:
+            return self.compositor.labels.hit(x, y)
 
     def mousePressEventPic(self, event):
         x, y = event.pos().x(), event.pos().y()
@@ -151,6 +577,15 @@ class Application(QWidget):
                 self.window().updateStatus("left: {}, {}, {}".format(x, y, this_obj))
             self.this_obj = this_obj
             self.this_pos = (x, y)
+            if this_obj != 0:
+                self.drag_start = self.state.transforms[this_obj - 1]
+                with self.render_lock:
+                    order = self.state.order
+                    if self.preview is not None:
+                        self.preview['compositor'].grab(
+                            self.preview['bkg'], self.preview['objects'], order, this_obj - 1)
+                    else:
+                        self.compositor.grab(self.bkg, self.objects, order, this_obj - 1)
 
     def mouseMoveEventPic(self, event):
         x, y = event.pos().x(), event.pos().y()
@@ -161,10 +596,11 @@ class Application(QWidget):
             move_x = (x - self.this_pos[0]) / self.ratio
             move_y = (y - self.this_pos[1]) / self.ratio
             self.this_pos = (x, y)
-            self.shift[self.this_obj - 1][0] += move_x
-            self.shift[self.this_obj - 1][1] += move_y
-            self.center[self.this_obj - 1][0] += move_x
-            self.center[self.this_obj - 1][1] += move_y
+            ind = self.this_obj - 1
+            t = self.state.transforms[ind]
+            # the whole drag is recorded once, on release
+            self.state.set_transform(
+                ind, t._replace(shift=(t.shift[0] + move_x, t.shift[1] + move_y)), record=False)
             self.manipulate()
         #elif event.buttons() == Qt.NoButton:
         #    if x >= self.pixmap_scope[0] or y >= self.pixmap_scope[1]:
@@ -178,44 +614,56 @@ class Application(QWidget):
 
     def mouseReleaseEventPic(self, event):
         QApplication.setOverrideCursor(Qt.OpenHandCursor)
+        if self.drag_start is not None:
+            ind = self.this_obj - 1
+            self.state.set_transform(ind, self.state.transforms[ind], old=self.drag_start)
+            self.drag_start = None
+        self.refine()
 
     def objectForward(self):
-        pos = np.where(self.order == self.this_obj - 1)[0].item()
-        if pos < self.order.shape[0] - 1:
-            tmp = self.order[pos + 1]
-            self.order[pos + 1] = self.this_obj - 1
-            self.order[pos] = tmp
-            self.paste_all()
+        order = list(self.state.order)
+        pos = order.index(self.this_obj - 1)
+        if pos < len(order) - 1:
+            order[pos], order[pos + 1] = order[pos + 1], order[pos]
+            self.reorder(order)
 
     def objectBackward(self):
-        pos = np.where(self.order == self.this_obj - 1)[0].item()
+        order = list(self.state.order)
+        pos = order.index(self.this_obj - 1)
         if pos > 0:
-            tmp = self.order[pos - 1]
-            self.order[pos - 1] = self.this_obj - 1
-            self.order[pos] = tmp
-            self.paste_all()
+            order[pos], order[pos - 1] = order[pos - 1], order[pos]
+            self.reorder(order)
  
     def objectFront(self):
-        pos = np.where(self.order == self.this_obj - 1)[0].item()
-        if pos < self.order.shape[0] - 1:
-            self.order = np.concatenate(
-                [self.order[:pos], self.order[pos + 1:],
-                np.array([self.this_obj - 1], dtype=np.int64)])
-            self.paste_all()
+        order = list(self.state.order)
+        pos = order.index(self.this_obj - 1)
+        if pos < len(order) - 1:
+            self.reorder(order[:pos] + order[pos + 1:] + [self.this_obj - 1])
 
     def objectBottom(self):
-        pos = np.where(self.order == self.this_obj - 1)[0].item()
+        order = list(self.state.order)
+        pos = order.index(self.this_obj - 1)
         if pos > 0:
-            self.order = np.concatenate(
-                [np.array([self.this_obj - 1], dtype=np.int64),
-                self.order[:pos], self.order[pos + 1:]])
-            self.paste_all()
+            self.reorder([self.this_obj - 1] + order[:pos] + order[pos + 1:])
+
+    def reorder(self, order):
+        self.flush(show=False)
+        self.state.set_order(order)
+        with self.render_lock:
+            # only where objects that swapped overlap is re-blended
+            dirty = self.compositor.reorder(self.bkg, self.objects, order)
+            if self.preview is not None:
+                self.preview['compositor'].reorder(
+                    self.preview['bkg'], self.preview['objects'], order)
+            self.markDirty(dirty, self.compositor.frame, self.previewing is not None)
+            self.previewing = None
+        self.showCanvas()
 
     def objectSave(self):
-        obj = self.objects[self.this_obj - 1]
-        crop_obj = utils.crop_padding(
-            obj, utils.mask_to_bbox(obj[:,:,3]), pad_value=(0,0,0,0))
-        self.window().objectSaveAs(crop_obj)
+        obj = self.transformObject(self.snapshot(self.this_obj - 1), self.export_interpolation)
+        if obj.empty():
+            return
+        self.window().objectSaveAs(obj.image)
 
     def contextMenuEventPic(self, event):
         if not self.deocc_flag:
@@ -247,73 +695,116 @@ class Application(QWidget):
         menu.addAction(saveAction)
         menu.exec_(self.mapToGlobal(event.pos()))
         
-    def moveObject(self, image, move_x, move_y):
-        bbox = [-move_x, -move_y, image.shape[1], image.shape[0]]
-        return utils.crop_padding(image, bbox, pad_value=(0,0,0,0))
-
-    def resizeObject(self, image, ratio):
-        if ratio == 1:
-            return image
-        else:
-            return utils.resize_with_center(image, self.center[self.this_obj - 1], ratio)
-
-    def rotateObject(self, image, degree):
-        if degree == 0:
-            return image
-        else:
-            return utils.rotate_with_center(image, self.center[self.this_obj - 1], degree)
+    def snapshot(self, ind, preview=False):
+        '''
+        Parameters of object ind, safe to use from another thread since the
+        state only holds immutable values.
+        '''
+        return {'ind': ind, 'source': self.state.sources[ind],
+                'transform': self.state.transforms[ind],
+                'order': self.state.order, 'preview': preview}
+
+    def transformObject(self, state, interpolation, source=None, factor=1.):
+        # the center moves along with the shift, so resizing and rotating
+        # around the original center, then moving, is equivalent
+        if source is None:
+            source = state['source']
+        t = state['transform']
+        with profiler.span('transform', ind=state['ind']):
+            return self.transform_cache.transform(
+                source, [v * factor for v in t.shift], t.scale, t.degree, interpolation)
 
     def keyPressEvent(self, event):
-        if event.key() == Qt.Key_Up and self.scale[self.this_obj - 1] > 0.2:
-            self.scale[self.this_obj - 1] -= 0.05
+        if not self.deocc_flag or self.this_obj == 0:
+            return
+        ind = self.this_obj - 1
+        t = self.state.transforms[ind]
+        if event.key() == Qt.Key_Up and t.scale > 0.2:
+            t = t._replace(scale=t.scale - 0.05)
         elif event.key() == Qt.Key_Down:
-            self.scale[self.this_obj - 1] += 0.05
+            t = t._replace(scale=t.scale + 0.05)
         elif event.key() == Qt.Key_Left:
-            self.degree[self.this_obj - 1] += 3
+            t = t._replace(degree=t.degree + 3)
         elif event.key() == Qt.Key_Right:
-            self.degree[self.this_obj - 1] -= 3
+            t = t._replace(degree=t.degree - 3)
         else:
             return
+        self.state.set_transform(ind, t)
         self.manipulate()
+        if self.preview is not None:
+            self.refineTimer.start()
 
     def manipulate(self):
-        # move
-        self.objects[self.this_obj - 1] = self.moveObject(
-            self.objects_ori[self.this_obj - 1],
-            self.shift[self.this_obj - 1][0], self.shift[self.this_obj - 1][1])
-        # resize
-        self.objects[self.this_obj - 1] = self.resizeObject(
-            self.objects[self.this_obj - 1], self.scale[self.this_obj - 1])
-        # rotate
-        self.objects[self.this_obj - 1] = self.rotateObject(
-            self.objects[self.this_obj - 1], self.degree[self.this_obj - 1])
-
-        self.paste_all()
-
-    def paste(self, image, ind=None):
-        if image.shape[2] == 4:
-            alpha = image[:,:,3:4].astype(np.float32) / 255
-            region = np.where(image[:,:,3] > 0)
-            self.canvas[region[0], region[1], :] = \
-                self.canvas[region[0], region[1], :] * (1 - alpha[region[0], region[1], :]) + \
-                image[region[0], region[1], :3] * alpha[region[0], region[1], :]
-            self.mask[region[0], region[1]] = ind
-        else:
-            self.canvas[...] = image.copy()
-            self.mask.fill(0)
+        self.stopShow()
+        # rendered by the worker, which then calls showCanvas
+        self.worker.request(self.snapshot(self.this_obj - 1, self.preview is not None))
+        if self.preview is not None:
+            self.refine_ind = self.this_obj - 1
+
+    def renderSnapshot(self, state):
+        with profiler.span('render', preview=state['preview']):
+            # layers are immutable and the transform cache has its own lock,
+            # so the UI thread only waits for the blending, not the warp
+            preview = self.preview if state['preview'] else None
+            if preview is not None:
+                layer = self.transformObject(
+                    state, self.interpolation, self.preview_source(state['source']),
+                    preview['factor'])
+            else:
+                # move, resize and rotate in a single resampling, or none if cached
+                layer = self.transformObject(state, self.interpolation)
+            with self.render_lock:
+                if preview is not None:
+                    preview['objects'][state['ind']] = layer
+                    dirty = preview['compositor'].update(
+                        preview['bkg'], preview['objects'], state['order'], state['ind'])
+                    self.markDirty(dirty, preview['compositor'].frame, self.previewing is None)
+                    self.previewing = state['ind']
+                    self.publish()
+                    return
+                self.objects[state['ind']] = layer
+                # only the region covered by the object before and after is re-blended
+                dirty = self.compositor.update(
+                    self.bkg, self.objects, state['order'], state['ind'])
+                self.markDirty(dirty, self.compositor.frame, self.previewing is not None)
+                self.previewing = None
+                self.publish()
+
+    def markDirty(self, region, frame, switched):
+        if switched:
+            # the other resolution was shown so far
+            self.dirty = frame
+        elif region is not None:
+            import utils
+            self.dirty = utils.bbox_union(self.dirty or [0, 0, 0, 0], region)
 
     def showCanvas(self):
-        if self.canvas is not None:
-            self.canvas_show = QImage(
-                self.canvas.data, self.image_width, self.image_height,
-                3 * self.image_width, QImage.Format_RGB888)
+        if self.canvas is None or self.isolated is not None:
+            return
+        with profiler.span('showCanvas'):
+            # while the worker composites, it publishes its frame once done
+            if self.render_lock.acquire(blocking=False):
+                try:
+                    self.publish()
+                finally:
+                    self.render_lock.release()
+            self.canvasView.present()
+
+    def publish(self):
+        '''
+        Hand the shown canvas, or its dirty region, to the view, with
+        render_lock held.
+        '''
+        if self.canvas is None or self.isolated is not None:
+            return
+        if self.previewing is not None:
+            buffer = self.preview['compositor'].canvas
+            scale = self.ratio / self.preview['factor']
         else:
-            self.canvas_show = QImage()
-        pixmap = QPixmap.fromImage(self.canvas_show)
-        #pixmap = pixmap.scaled(self.main_width, self.main_height, Qt.KeepAspectRatio)
-        self.pixmap_scope = (pixmap.size().width(), pixmap.size().height())
-        self.ratio = pixmap.size().height() / float(self.image_height)
-        self.imageLabel.setFixedHeight(pixmap.size().height())
-        self.imageLabel.setFixedWidth(pixmap.size().width())
-        self.imageLabel.setPixmap(pixmap)
-        self.imageLabel.show()
+            buffer = self.canvas
+            scale = self.ratio
+        dirty, self.dirty = self.dirty, None
+        if buffer is not self.canvasView.buffer or dirty is not None:
+            self.recordFrame(buffer)
+            profiler.frame()
+            self.canvasView.publish(buffer, scale, dirty)
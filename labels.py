@@ -0,0 +1,59 @@
+import numpy as np
+
+class LabelMap(object):
+    '''
+    Which object is at each pixel, 0 is background and i + 1 is objects[i].
+    Clicks are answered from the layers directly, top-most first among the
+    ones whose bbox contains the click, and the full map is only rebuilt
+    when it is queried after the scene changed.
+    '''
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.objects = []
+        self.order = []
+        self.index = None
+        self.labels = None
+
+    def update(self, objects, order, index=None):
+        '''
+        index: LayerIndex of objects, e.g. the compositor's
+        '''
+        self.objects = list(objects)
+        self.order = list(order)
+        self.index = index
+        self.labels = None
+
+    def hit(self, x, y):
+        if self.index is not None:
+            candidates = set(self.index.at(x, y).tolist())
+            order = [ind for ind in self.order if ind in candidates]
+        else:
+            order = self.order
+        for ind in reversed(order):
+            if self.objects[ind].hit(x, y):
+                return ind + 1
+        return 0
+
+    def get(self):
+        '''
+        HxW label map, uint8 or uint16 depending on the number of objects.
+        '''
+        if self.labels is None:
+            dtype = np.uint8 if len(self.objects) < 255 else np.uint16
+            labels = np.zeros((self.height, self.width), dtype=dtype)
+            for ind in self.order:
+                obj = self.objects[ind]
+                if obj.coverage == 0:
+                    continue
+                x, y, w, h = obj.bbox
+                # clip to the frame
+                x1, y1 = max(x, 0), max(y, 0)
+                x2, y2 = min(x + w, self.width), min(y + h, self.height)
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                alpha = obj.crop([x1, y1, x2 - x1, y2 - y1])[:,:,3]
+                labels[y1 : y2, x1 : x2][alpha > 0] = ind + 1
+            self.labels = labels
+        return self.labels
@@ -0,0 +1,189 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import utils
+from profiling import profiler
+
+class Layer(object):
+    '''
+    An RGBA object stored as the crop of its alpha bbox, plus the offset of
+    the crop in the frame. Layers are never modified in place, transforming
+    one returns a new layer.
+    '''
+
+    def __init__(self, image, offset, center=None, coverage=None):
+        '''
+        image: hxwx4 np.ndarray, tightly cropped
+        offset: (x,y) of image in the frame
+        center: (x,y) in the frame, computed from image if None
+        coverage: number of non-zero alpha pixels, computed from image if None
+        '''
+        self.image = image
+        self.offset = (int(offset[0]), int(offset[1]))
+        h, w = image.shape[:2]
+        self.bbox = [self.offset[0], self.offset[1], w, h] # xywh
+        if center is None:
+            _, (cx, cy), coverage = utils.alpha_geometry(image[:,:,3])
+            center = [cx + self.offset[0], cy + self.offset[1]]
+        elif coverage is None:
+            coverage = np.count_nonzero(image[:,:,3])
+        self.center = list(center)
+        self.coverage = int(coverage)
+
+    @classmethod
+    def from_image(cls, image, offset=(0, 0)):
+        '''
+        Crop image (HxWx4) to the bbox of its non-zero alpha. The center and
+        coverage are found in the same pass.
+        '''
+        (x, y, w, h), (cx, cy), coverage = utils.alpha_geometry(image[:,:,3])
+        crop = image[y : y + h, x : x + w].copy()
+        return cls(crop, (offset[0] + x, offset[1] + y),
+                   (offset[0] + cx, offset[1] + cy), coverage)
+
+    @classmethod
+    def centered(cls, image, shape):
+        '''
+        Place image (hxwx4) at the center of a frame of shape (H,W).
+        '''
+        h, w = image.shape[:2]
+        return cls.from_image(image, ((shape[1] - w) // 2, (shape[0] - h) // 2))
+
+    def empty(self):
+        return self.bbox[2] == 0 or self.bbox[3] == 0
+
+    def crop(self, region):
+        '''
+        region: (x,y,w,h) in the frame, must lie within self.bbox
+        '''
+        x, y, w, h = region
+        x -= self.offset[0]
+        y -= self.offset[1]
+        return self.image[y : y + h, x : x + w]
+
+    def to_frame(self, shape):
+        '''
+        The layer in a transparent frame of shape (H,W), like decompositions.
+        '''
+        frame = np.zeros((shape[0], shape[1], 4), dtype=np.uint8)
+        x, y, w, h = utils.bbox_intersection(self.bbox, [0, 0, shape[1], shape[0]])
+        if w > 0 and h > 0:
+            frame[y : y + h, x : x + w] = self.crop((x, y, w, h))
+        return frame
+
+    def hit(self, x, y):
+        x, y = int(x) - self.offset[0], int(y) - self.offset[1]
+        h, w = self.image.shape[:2]
+        return 0 <= x < w and 0 <= y < h and self.image[y, x, 3] > 0
+
+    def translate(self, dx, dy):
+        '''
+        Move by whole pixels, sharing the pixels with self.
+        '''
+        dx, dy = int(round(dx)), int(round(dy))
+        return Layer(self.image, (self.offset[0] + dx, self.offset[1] + dy),
+                     (self.center[0] + dx, self.center[1] + dy), self.coverage)
+
+    def transform(self, matrix, frame=None, interpolation='bilinear'):
+        '''
+        matrix: 2x3 in frame coordinates, e.g. from utils.affine_matrix
+        frame: (x,y,w,h) the output is clipped to, no clipping if None
+        '''
+        if self.empty():
+            return self
+        # from crop coordinates
+        matrix = matrix.copy()
+        matrix[:, 2] += matrix[:, :2].dot(np.array(self.offset, dtype=np.float64))
+        h, w = self.image.shape[:2]
+        dst = utils.transform_bbox([0, 0, w, h], matrix)
+        if frame is not None:
+            dst = utils.bbox_intersection(dst, frame)
+        if dst[2] == 0 or dst[3] == 0:
+            return Layer(np.zeros((0, 0, 4), dtype=np.uint8), dst[:2])
+        image = utils.warp_affine(self.image, matrix, dst, interpolation)
+        return Layer.from_image(image, dst[:2])
+
+    def half(self):
+        '''
+        Half resolution copy, for previews.
+        '''
+        if self.empty():
+            return Layer(self.image, (self.offset[0] // 2, self.offset[1] // 2))
+        # align the crop to even frame coordinates
+        px, py = self.offset[0] % 2, self.offset[1] % 2
+        image = cv2.copyMakeBorder(
+            self.image, py, 0, px, 0, cv2.BORDER_CONSTANT, value=0)
+        image = utils.pyr_down(image, cv2.BORDER_CONSTANT)
+        return Layer.from_image(
+            image, ((self.offset[0] - px) // 2, (self.offset[1] - py) // 2))
+
+class LayerIndex(object):
+    '''
+    The bboxes of a list of layers as one Nx4 (xywh) array, for batched
+    overlap and hit tests.
+    '''
+
+    def __init__(self, layers=()):
+        self.bboxes = np.array([layer.bbox for layer in layers], dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def update(self, ind, layer):
+        self.bboxes[ind] = layer.bbox
+
+    def at(self, x, y):
+        '''
+        Indices of the layers whose bbox contains (x,y).
+        '''
+        x1, y1, w, h = self.bboxes.T
+        return np.flatnonzero((x1 <= x) & (x < x1 + w) & (y1 <= y) & (y < y1 + h))
+
+class TransformCache(object):
+    '''
+    LRU cache of resized and rotated layers, keyed by the source layer,
+    scale, degree and interpolation. Moves are applied afterwards with
+    Layer.translate, so dragging never misses. Least recently used entries
+    are evicted once the cached pixels exceed budget bytes.
+    '''
+
+    def __init__(self, budget=256 << 20):
+        self.budget = budget
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def transform(self, src, shift, scale, degree, interpolation='bilinear'):
+        '''
+        src resized by scale and rotated by degree around src.center, then
+        moved by shift.
+        '''
+        scale, degree = round(scale, 6), round(degree, 6)
+        if scale == 1 and degree == 0:
+            return src.translate(*shift)
+        # the entry keeps src alive, so its id is not reused meanwhile
+        key = (id(src), scale, degree, interpolation)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[1].translate(*shift)
+        matrix = utils.affine_matrix([0, 0], scale, degree, src.center)
+        with profiler.span('warp', scale=scale, degree=degree):
+            layer = src.transform(matrix, None, interpolation)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (src, layer)
+                self.nbytes += layer.image.nbytes
+            while self.nbytes > self.budget and len(self.entries) > 1:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.nbytes -= old.image.nbytes
+        return layer.translate(*shift)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
@@ -1,26 +1,45 @@
 import sys
 import os
 import time
-from glob import glob
-import cv2
+# for --startup-profile
+launch = time.perf_counter()
+import argparse
+import importlib
+import threading
 
-from PIL import Image
-import numpy as np
-
-from PyQt5.QtWidgets import (QAction, QApplication, QDockWidget, QFileDialog, QMainWindow, QLabel, QDesktopWidget, QListWidget)
+from PyQt5.QtWidgets import (QAction, QApplication, QDockWidget, QFileDialog, QMainWindow, QLabel, QListWidget, QProgressDialog)
 from PyQt5.QtGui import (QImage, QImageWriter, QKeySequence, QPixmap)
-from PyQt5.QtCore import Qt
-from PyQt5.QtTest import QTest
+from PyQt5.QtCore import Qt, QTimer
 
+# numpy, cv2, PIL and the pipeline are imported on first use, or by
+# warm_up() once the window is shown
 import deocc_app
+from profiling import profiler
+
+# imported in the background after startup, dependencies first
+WARM_UP = ['numpy', 'cv2', 'PIL.Image', 'utils', 'layer', 'compositor', 'scene', 'animation']
+
+def warm_up(report=None):
+    for name in WARM_UP:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        if report is not None:
+            report.append((name, time.perf_counter() - start))
 
 class MainWindow(QMainWindow):
 
-    def __init__(self):
+    def __init__(self, warm=True, startup=None):
+        '''
+        warm: import the heavy modules in the background once shown
+        startup: list of (phase, time.perf_counter()) to print a startup
+        report into, see --startup-profile
+        '''
         super(MainWindow, self).__init__()
 
         self.debug = False
-        screen = QDesktopWidget().screenGeometry()
+        self.warm = warm
+        self.startup = startup
+        #screen = QDesktopWidget().screenGeometry()
         #self.swidth, self.sheight = screen.width(), screen.height()
         self.swidth, self.sheight = 800, 560
         self.setGeometry(0, 0, self.swidth, self.sheight)
@@ -48,6 +67,15 @@ class MainWindow(QMainWindow):
         fileSaveAsAction = self.createAction(
             'Save &As...', slot=self.fileSaveAs, shortcut=QKeySequence.SaveAs,
             tip='save image file using a new name')
+        fileExportAction = self.createAction(
+            '&Export Objects...', slot=self.fileExportObjects,
+            tip='export the objects shown one by one as an animation')
+        fileExportAllAction = self.createAction(
+            'Export A&ll...', slot=self.fileExportAll,
+            tip='save the background, every object and the composite to a folder')
+        self.fileRecordAction = self.createAction(
+            '&Record Session...', tip='record what is shown to an animation', checkable=True)
+        self.fileRecordAction.toggled.connect(self.fileRecord)
         fileQuitAction = self.createAction(
             '&Quit...', slot=self.close, shortcut='Ctrl + Q',
             tip='Close the Application')
@@ -56,27 +84,62 @@ class MainWindow(QMainWindow):
             'Deocclusion', slot=self.editDeocc, shortcut='Ctrl+E', tip='perform de-occlusion')
         editResetAction = self.createAction(
             'Reset', slot=self.mainApp.reset, shortcut='Ctrl+R', tip='reset image')
+        editUndoAction = self.createAction(
+            '&Undo', slot=self.mainApp.undo, shortcut=QKeySequence.Undo, tip='undo the last edit')
+        editRedoAction = self.createAction(
+            '&Redo', slot=self.mainApp.redo, shortcut=QKeySequence.Redo, tip='redo the last undone edit')
+
+        self.profileAction = self.createAction(
+            '&Profiling', tip='time the stages of every frame', checkable=True)
+        self.profileAction.setChecked(profiler.enabled)
+        self.profileAction.toggled.connect(self.profileEnable)
+        profileSaveAction = self.createAction(
+            '&Save Trace...', slot=self.profileSave, tip='save the spans as Chrome trace JSON')
+        profileClearAction = self.createAction(
+            '&Clear', slot=profiler.clear, tip='forget the recorded spans')
 
         # menu
         self.fileMenu = self.menuBar().addMenu('&File')
         self.fileMenu.addAction(fileOpenAction)
         #self.fileMenu.addAction(fileSaveAction)
         self.fileMenu.addAction(fileSaveAsAction)
+        self.fileMenu.addAction(fileExportAction)
+        self.fileMenu.addAction(fileExportAllAction)
+        self.fileMenu.addAction(self.fileRecordAction)
         self.fileMenu.addSeparator()
         self.fileMenu.addAction(fileQuitAction)
 
         self.editMenu = self.menuBar().addMenu('&Edit')
         self.editMenu.addAction(editDeoccAction)
         self.editMenu.addAction(editResetAction)
+        self.editMenu.addSeparator()
+        self.editMenu.addAction(editUndoAction)
+        self.editMenu.addAction(editRedoAction)
+
+        self.profileMenu = self.menuBar().addMenu('&Profile')
+        self.profileMenu.addAction(self.profileAction)
+        self.profileMenu.addAction(profileSaveAction)
+        self.profileMenu.addAction(profileClearAction)
+
+        # rolling frame times while profiling
+        self.profileLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.profileLabel)
+        self.profileTimer = QTimer(self)
+        self.profileTimer.setInterval(500)
+        self.profileTimer.timeout.connect(self.profileUpdate)
+        self.profileEnable(profiler.enabled)
 
         self.setWindowTitle('De-Occlusion')
         #self.showMaximized()
         self.show()
+        # runs once the window is up
+        QTimer.singleShot(0, self.shown)
 
     def addMainApp(self):
         self.mainApp = deocc_app.Application(self, (self.swidth, self.sheight), self.debug)
         self.setCentralWidget(self.mainApp)
         self.keyPressEvent = self.mainApp.keyPressEvent
+        self.mainApp.saved.connect(self.saveDone)
         
     def createAction(self, text, slot=None, shortcut=None, tip=None, checkable=False, signal='triggered'):
         action = QAction(text, self)
@@ -91,21 +154,55 @@ class MainWindow(QMainWindow):
             action.setCheckable(True)
         return action
 
+    def shown(self):
+        if self.startup is not None:
+            self.startup.append(('window shown', time.perf_counter()))
+        if not self.warm:
+            self.startupReport([])
+            return
+        def run():
+            report = []
+            warm_up(report)
+            self.startupReport(report)
+        threading.Thread(target=run, daemon=True).start()
+
+    def startupReport(self, warmed):
+        if self.startup is None:
+            return
+        lines = ['startup, ms since main.py started:']
+        lines += ['  {:<16} {:>8.1f}'.format(phase, (t - launch) * 1e3) for phase, t in self.startup]
+        if warmed:
+            lines.append('background warm-up, ms per module:')
+            lines += ['  {:<16} {:>8.1f}'.format(name, t * 1e3) for name, t in warmed]
+        lines.append('(python -X importtime main.py details the imports)')
+        print('\n'.join(lines), file=sys.stderr)
+
     def editDeocc(self):
-        file_dir = self.filename[:-4]
-        obj_fns = sorted(glob("{}/obj_*.png".format(file_dir)))[::-1]
+        import scene
+        file_dir = scene.find_scene(self.filename)
         #obj_list = os.path.join(file_dir, "objects.txt")
         #with open(obj_list, 'r') as f:
         #    lines = f.readlines()
         #obj_fns = [os.path.join(file_dir, l.strip()) for l in lines]
-        bkg = np.array(Image.open(os.path.join(file_dir, "bkg.png")))
-        objects = [np.array(Image.open(fn)) for fn in obj_fns]
+        progress = QProgressDialog('Loading components...', None, 0, 0, self)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(200)
+        def update(done, total):
+            progress.setMaximum(total)
+            progress.setValue(done)
+            QApplication.processEvents()
+        try:
+            bkg, objects = scene.load_scene(file_dir, update)
+        finally:
+            progress.close()
         self.mainApp.init_components(bkg, objects)
 
     def insertObject(self):
         filename, _ = QFileDialog.getOpenFileName(self, 'Select an object: ', '.', filter='*.png')
         if filename is None:
             return
+        import numpy as np
+        from PIL import Image
         new_object = np.array(Image.open(filename)) # RGBA
         self.mainApp.insert_object(new_object)
 
@@ -113,6 +210,8 @@ class MainWindow(QMainWindow):
         self.filename, _ = QFileDialog.getOpenFileName(self, 'Select an image file: ', filter='*.jpg *.png')
         if self.filename is None or len(self.filename) == 0:
             return
+        import numpy as np
+        from PIL import Image
         image_ori = np.array(Image.open(self.filename).convert('RGB'))
         self.mainApp.init_image(image_ori)
 
@@ -122,7 +221,7 @@ class MainWindow(QMainWindow):
         if self.filename is None:
             self.fileSaveAs()
         else:
-            self.mainApp.canvas_show.save(self.filename, None)
+            self.mainApp.saveCanvas(self.filename)
 
     def fileSaveAs(self):
         if self.mainApp.canvas_show.isNull():
@@ -144,15 +243,99 @@ class MainWindow(QMainWindow):
         if fname:
             if '.' not in fname:
                 fname += '.png'
-            obj = np.concatenate([obj[:,:,:3][:,:,::-1], obj[:,:,3:4]], axis=2)
-            cv2.imwrite(fname, obj)
+            self.mainApp.saveObject(fname, obj)
+
+    def getAnimationName(self, title):
+        fname, _ = QFileDialog.getSaveFileName(self, title, '.', 'Animations (*.gif *.mp4)')
+        if fname and '.' not in os.path.basename(fname):
+            fname += '.gif'
+        return fname
+
+    def fileExportObjects(self):
+        if not self.mainApp.deocc_flag:
+            return
+        fname = self.getAnimationName('De-occlusion - Export objects')
+        if fname:
+            self.mainApp.exportObjects(fname)
+
+    def fileExportAll(self):
+        if not self.mainApp.deocc_flag:
+            return
+        out_dir = QFileDialog.getExistingDirectory(self, 'De-occlusion - Export all', '.')
+        if out_dir:
+            self.mainApp.exportAll(out_dir)
+
+    def saveDone(self, fname, error):
+        if error:
+            if self.mainApp.recorder is None and self.fileRecordAction.isChecked():
+                # the recording failed and was stopped
+                self.fileRecordAction.setChecked(False)
+            self.updateStatus('failed to save {}: {}'.format(fname, error))
+        else:
+            self.updateStatus('saved {}'.format(fname))
+
+    def fileRecord(self, checked):
+        if not checked:
+            count = self.mainApp.stopRecording()
+            if count is not None:
+                self.updateStatus('recorded {} frames'.format(count))
+            return
+        fname = self.getAnimationName('De-occlusion - Record session')
+        if not fname:
+            self.fileRecordAction.setChecked(False)
+            return
+        self.mainApp.startRecording(fname)
+
+    def profileEnable(self, checked):
+        profiler.enable(checked)
+        self.profileLabel.setVisible(checked)
+        if checked:
+            self.profileTimer.start()
+        else:
+            self.profileTimer.stop()
+
+    def profileUpdate(self):
+        self.profileLabel.setText(profiler.summary(
+            ['render', 'transform', 'update', 'showCanvas', 'paint']))
+
+    def profileSave(self):
+        fname, _ = QFileDialog.getSaveFileName(
+            self, 'De-occlusion - Save trace', 'trace.json', 'Chrome traces (*.json)')
+        if fname:
+            self.updateStatus('saved {} spans to {}'.format(profiler.save(fname), fname))
+
+    def closeEvent(self, event):
+        self.mainApp.stopShow()
+        self.mainApp.stopRecording()
+        self.mainApp.worker.stop()
+        self.mainApp.waitSaved()
+        super(MainWindow, self).closeEvent(event)
 
     def updateStatus(self, message):
         self.statusBar().showMessage(message, 5000)
-        self.listWidget.addItem(message)
+        if self.debug:
+            self.listWidget.addItem(message)
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true', help='start with profiling on')
+    parser.add_argument('--trace', help='save the profiled spans to this file on exit')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print where the launch time goes')
+    parser.add_argument('--no-warm-up', action='store_true',
+                        help='import numpy, cv2, etc. only when first needed')
+    args, qt_args = parser.parse_known_args()
+    startup = [('imports', time.perf_counter())] if args.startup_profile else None
+    if args.profile or args.trace:
+        profiler.enable()
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setApplicationName("De-Occlusion")
-    form = MainWindow()
-    sys.exit(app.exec_())
+    if startup is not None:
+        startup.append(('QApplication', time.perf_counter()))
+    form = MainWindow(not args.no_warm_up, startup)
+    if startup is not None:
+        startup.append(('MainWindow', time.perf_counter()))
+    status = app.exec_()
+    if args.trace:
+        profiler.save(args.trace)
+    sys.exit(status)
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+class Profiler(object):
+    '''
+    Named spans around the stages of the pipeline, kept as Chrome trace
+    events (chrome://tracing, ui.perfetto.dev), plus rolling frame times.
+    While disabled, span() returns a shared no-op context manager and
+    frame() returns right away, so instrumented code costs a method call.
+    '''
+
+    def __init__(self, enabled=False, max_events=1 << 20, window=60):
+        self.enabled = enabled
+        self.window = window
+        self.lock = threading.Lock()
+        self.events = deque(maxlen=max_events)
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.frames = deque(maxlen=window)
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def name_thread(self, name):
+        '''
+        Name the calling thread in traces, for threads not started by the
+        threading module (e.g. QThread).
+        '''
+        self.thread_names[threading.get_ident()] = name
+
+    def span(self, name, **args):
+        '''
+        with profiler.span('update', ind=3): ...
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def add(self, name, start, end, args=None):
+        with self.lock:
+            self.events.append((name, threading.get_ident(), start, end, args))
+            self.durations[name].append(end - start)
+
+    def frame(self):
+        '''
+        Mark a frame as shown, for the frame rate.
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            # a pause starts a new burst of frames
+            if self.frames and now - self.frames[-1] > 1.:
+                self.frames.clear()
+            self.frames.append(now)
+
+    def fps(self):
+        with self.lock:
+            if len(self.frames) < 2:
+                return 0.
+            return (len(self.frames) - 1) / max(self.frames[-1] - self.frames[0], 1e-9)
+
+    def mean(self, name):
+        '''
+        Rolling mean duration of span name, in seconds.
+        '''
+        with self.lock:
+            durations = self.durations.get(name)
+            if not durations:
+                return 0.
+            return sum(durations) / len(durations)
+
+    def summary(self, names=()):
+        fps = self.fps()
+        text = ['{:.1f} fps'.format(fps)]
+        if fps > 0:
+            text.append('frame {:.1f} ms'.format(1e3 / fps))
+        for name in names:
+            text.append('{} {:.1f} ms'.format(name, self.mean(name) * 1e3))
+        return ' | '.join(text)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.durations.clear()
+            self.frames.clear()
+
+    def save(self, filename):
+        '''
+        Write the recorded spans as Chrome trace-event JSON.
+        '''
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        tids = {}
+        for name, tid, start, end, args in events:
+            # small thread ids read better in the viewers
+            tid = tids.setdefault(tid, len(tids))
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+            if args:
+                event['args'] = args
+            trace.append(event)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        names.update(self.thread_names)
+        for ident, tid in tids.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                          'args': {'name': names.get(ident, 'thread {}'.format(tid))}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(trace)
+
+# shared by the compositor and the app
+profiler = Profiler(enabled=bool(os.environ.get('DEOCC_PROFILE')))
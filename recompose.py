@@ -0,0 +1,174 @@
+'''
+Headless recomposition of decomposed images, without Qt.
+
+    python recompose.py specs.jsonl --out-dir outputs --labels --workers 8
+
+specs is a JSON list or a JSON-lines file of scene specs:
+
+    {"scene": "decomposition/image_1316",
+     "objects": [{"shift": [20, 0], "scale": 1.2, "degree": 15}, null],
+     "insert": [{"material": "materials/cat.png", "shift": [-100, 40], "scale": 0.5}],
+     "order": [1, 0, 2],
+     "output": "image_1316_000.png"}
+
+objects are indexed like in the demo (bottom first), inserted materials are
+appended after them and start centered. Every key but scene is optional.
+Specs that fail (e.g. a missing scene or material, more object
+parameters than the scene has objects, or an order that is not a
+permutation of the objects and materials) do not stop the others, they are
+listed at the end and the exit status is 1.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import cv2
+
+import scene
+from compositor import Compositor
+from layer import TransformCache
+
+# per process, scenes are cached by scene.load_scene
+material_cache_size = 32
+_materials = OrderedDict()
+_materials_lock = threading.Lock()
+_cache = TransformCache()
+
+def get_material(filename, shape, load=scene.load_material):
+    '''
+    The material centered in a frame of shape (H,W), the last
+    material_cache_size are cached.
+    load: (filename, shape) -> Layer, called on a miss
+    '''
+    key = (filename, tuple(shape))
+    with _materials_lock:
+        if key in _materials:
+            _materials.move_to_end(key)
+            return _materials[key]
+    layer = load(filename, shape)
+    with _materials_lock:
+        _materials[key] = layer
+        while len(_materials) > material_cache_size:
+            _materials.popitem(last=False)
+    return layer
+
+def recompose(bkg, objects, spec, interpolation='bicubic', cache=_cache, threads=1,
+              compositor=None, material=get_material):
+    '''
+    bkg: HxWx3 np.ndarray
+    objects: layers, bottom first
+    spec: see the module docstring
+    threads: compositing threads, see Compositor
+    compositor: reused if given and of the size of bkg, its canvas is then
+    overwritten by the next call
+    material: (name, shape) -> Layer, for the materials to insert
+    Returns the canvas (HxWx3, RGB), the same as Application.canvas, and a
+    labels.LabelMap, whose get() gives the label of every pixel.
+    '''
+    shape = bkg.shape[:2]
+    params = list(spec.get('objects') or [])
+    if len(params) > len(objects):
+        raise ValueError('{} object parameters for {} objects'.format(len(params), len(objects)))
+    inserts = spec.get('insert') or []
+    objects = list(objects) + [material(m['material'], shape) for m in inserts]
+    params += [None] * (len(objects) - len(inserts) - len(params)) + list(inserts)
+    layers = []
+    for obj, p in zip(objects, params):
+        p = p or {}
+        layers.append(cache.transform(
+            obj, p.get('shift', [0, 0]), p.get('scale', 1.), p.get('degree', 0.),
+            interpolation))
+    order = spec.get('order')
+    if order is None:
+        order = range(len(layers))
+    elif sorted(order) != list(range(len(layers))):
+        raise ValueError('order {} is not a permutation of the {} layers'.format(order, len(layers)))
+    if compositor is None or compositor.canvas.shape[:2] != shape:
+        compositor = Compositor(shape[0], shape[1], threads)
+    compositor.paste_all(bkg, layers, order)
+    return compositor.canvas, compositor.labels
+
+def output_name(index, spec):
+    if spec.get('output'):
+        return spec['output']
+    return '{}_{:06d}.png'.format(os.path.basename(os.path.normpath(spec['scene'])), index)
+
+def write_image(fname, image):
+    if not cv2.imwrite(fname, image):
+        raise IOError('cannot write {}'.format(fname))
+
+def render_job(job):
+    '''
+    Returns (index, error), error is None on success, so that one bad spec
+    does not stop the others.
+    '''
+    index, spec, out_dir, labels, interpolation, threads = job
+    try:
+        bkg, objects = scene.load_scene(spec['scene'])
+        canvas, label_map = recompose(bkg, objects, spec, interpolation, threads=threads)
+        fname = os.path.join(out_dir, output_name(index, spec))
+        write_image(fname, canvas[:,:,::-1])
+        if labels:
+            write_image(os.path.splitext(fname)[0] + '_label.png', label_map.get())
+    except Exception as e:
+        return index, '{}: {}'.format(type(e).__name__, e)
+    return index, None
+
+def read_specs(filename):
+    with open(filename, 'r') as f:
+        if filename.endswith('.jsonl'):
+            return [json.loads(l) for l in f if l.strip()]
+        specs = json.load(f)
+    return specs if isinstance(specs, list) else [specs]
+
+def init_worker():
+    # one thread per process, parallelism comes from the pool
+    cv2.setNumThreads(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompose decomposed images.')
+    parser.add_argument('specs', help='.json or .jsonl scene specs')
+    parser.add_argument('--out-dir', default='outputs')
+    parser.add_argument('--labels', action='store_true', help='also write label masks')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='0 renders in this process')
+    parser.add_argument('--interpolation', default='bicubic',
+                        choices=['nearest', 'bilinear', 'bicubic', 'lanczos'])
+    parser.add_argument('--threads', type=int, default=1,
+                        help='compositing threads per scene, for very large images')
+    parser.add_argument('--chunksize', type=int, default=4)
+    args = parser.parse_args()
+
+    specs = read_specs(args.specs)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    jobs = [(i, spec, args.out_dir, args.labels, args.interpolation, args.threads)
+            for i, spec in enumerate(specs)]
+
+    start = time.time()
+    if args.workers == 0:
+        init_worker()
+        results = [render_job(job) for job in jobs]
+    else:
+        # group jobs of the same scene, so that workers reuse loaded scenes
+        jobs.sort(key=lambda job: str(job[1].get('scene')))
+        with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+            results = list(pool.imap_unordered(render_job, jobs, chunksize=args.chunksize))
+    failed = sorted((index, error) for index, error in results if error is not None)
+    elapsed = time.time() - start
+    done = len(jobs) - len(failed)
+    print('{} scenes in {:.2f}s, {:.1f} scenes/s, {} workers'.format(
+        done, elapsed, done / max(elapsed, 1e-9), args.workers))
+    if failed:
+        for index, error in failed:
+            print('spec {} failed: {}'.format(index, error), file=sys.stderr)
+        print('{} of {} specs failed'.format(len(failed), len(jobs)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
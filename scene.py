@@ -0,0 +1,207 @@
+import os
+import json
+import struct
+import argparse
+import threading
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from layer import Layer
+
+# decoded scenes, keyed by path and mtime of their files
+cache_size = 4
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return _executor
+
+def read_png(filename):
+    '''
+    Decode with cv2, which releases the GIL, and return RGB(A).
+    '''
+    img = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError("cannot read {}".format(filename))
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def read_layer(filename):
+    return Layer.from_image(read_png(filename))
+
+def load_scene(file_dir, progress=None):
+    '''
+    Load a decomposed image, i.e. file_dir/bkg.png and file_dir/obj_*.png,
+    or a packed scene file (see pack_scene).
+    Returns the background (HxWx3, read-only) and the objects as layers,
+    bottom first. Files are decoded concurrently, and scenes are cached
+    until one of their files changes.
+    progress: called with (done, total) as files get decoded
+    '''
+    if file_dir.endswith(PACKED_EXT):
+        return load_packed(file_dir, progress)
+    obj_fns = sorted(glob("{}/obj_*.png".format(file_dir)))[::-1]
+    fns = [os.path.join(file_dir, "bkg.png")] + obj_fns
+    key = (os.path.abspath(file_dir), tuple((fn, os.path.getmtime(fn)) for fn in fns))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            if progress is not None:
+                progress(len(fns), len(fns))
+            return _cache[key]
+
+    executor = get_executor()
+    futures = {executor.submit(read_png, fns[0]): 0}
+    futures.update({executor.submit(read_layer, fn): i + 1 for i, fn in enumerate(obj_fns)})
+    results = [None] * len(fns)
+    for done, future in enumerate(as_completed(futures), 1):
+        results[futures[future]] = future.result()
+        if progress is not None:
+            progress(done, len(fns))
+    bkg, objects = results[0], results[1:]
+    bkg.flags.writeable = False
+    cache_put(key, (bkg, objects))
+    return bkg, objects
+
+def cache_put(key, scene):
+    with _cache_lock:
+        _cache[key] = scene
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+
+def find_scene(filename):
+    '''
+    Components of an image, packed scene file first: image_0141.png ->
+    image_0141.scene or image_0141/
+    '''
+    file_dir = os.path.splitext(filename)[0]
+    if os.path.isfile(file_dir + PACKED_EXT):
+        return file_dir + PACKED_EXT
+    return file_dir
+
+# Packed scenes: magic, header length (uint32, little endian), JSON header,
+# then the background and the cropped objects as raw uint8 arrays, each
+# aligned to PACKED_ALIGN bytes so that they can be memory-mapped in place.
+PACKED_EXT = '.scene'
+PACKED_MAGIC = b'DEOCCSC1'
+PACKED_ALIGN = 64
+
+def pack_scene(file_dir, filename=None):
+    '''
+    Convert a decomposition directory to a packed scene file.
+    '''
+    if filename is None:
+        filename = os.path.normpath(file_dir) + PACKED_EXT
+    bkg, objects = load_scene(file_dir)
+    arrays = [bkg] + [obj.image for obj in objects]
+    header = {'version': 1, 'height': bkg.shape[0], 'width': bkg.shape[1], 'arrays': [],
+              'objects': [{'offset': list(obj.offset), 'center': list(obj.center),
+                           'coverage': obj.coverage}
+                          for obj in objects]} # bottom first
+    # offsets relative to the data section, which starts after the header
+    pos = 0
+    for arr in arrays:
+        header['arrays'].append({'start': pos, 'shape': list(arr.shape)})
+        pos += -(-arr.nbytes // PACKED_ALIGN) * PACKED_ALIGN
+    starts = [arr['start'] for arr in header['arrays']]
+    header = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(PACKED_MAGIC) + 4 + len(header)) // PACKED_ALIGN) * PACKED_ALIGN
+    with open(filename, 'wb') as f:
+        f.write(PACKED_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for start, arr in zip(starts, arrays):
+            f.write(b'\0' * (data_start + start - f.tell()))
+            f.write(np.ascontiguousarray(arr, dtype=np.uint8).tobytes())
+    return filename
+
+def load_packed(filename, progress=None):
+    '''
+    Memory-map a packed scene, the layers are views paged in on first use.
+    '''
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    with open(filename, 'rb') as f:
+        if f.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise IOError("{} is not a packed scene".format(filename))
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = -(-(len(PACKED_MAGIC) + 4 + header_len) // PACKED_ALIGN) * PACKED_ALIGN
+    mm = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = []
+    for arr in header['arrays']:
+        start = data_start + arr['start']
+        arrays.append(np.asarray(mm[start : start + int(np.prod(arr['shape']))]).reshape(arr['shape']))
+    bkg = arrays[0]
+    # the geometry is stored, so that the layers are not read until drawn
+    objects = [Layer(image, obj['offset'], obj['center'], obj.get('coverage'))
+               for image, obj in zip(arrays[1:], header['objects'])]
+    if progress is not None:
+        progress(len(arrays), len(arrays))
+    cache_put(key, (bkg, objects))
+    return bkg, objects
+
+def write_png(filename, image, compression=3):
+    '''
+    Encode RGB(A) with cv2, which releases the GIL.
+    compression: PNG compression level, 0 (fastest) to 9 (smallest)
+    '''
+    code = cv2.COLOR_RGBA2BGRA if image.shape[2] == 4 else cv2.COLOR_RGB2BGR
+    if not cv2.imwrite(filename, cv2.cvtColor(image, code),
+                       [cv2.IMWRITE_PNG_COMPRESSION, compression]):
+        raise IOError("cannot write {}".format(filename))
+    return filename
+
+def export_scene(out_dir, bkg, objects, order, canvas=None, compression=3):
+    '''
+    Write the background, every object in a frame-sized RGBA image and the
+    composite concurrently, laid out like a decomposition, so that out_dir
+    can be opened with load_scene: out_dir/bkg.png, out_dir/obj_*.png
+    (obj_000 on top) and out_dir/composite.png if canvas is given.
+    Returns the filenames.
+    '''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    jobs = [(os.path.join(out_dir, 'bkg.png'), bkg)]
+    for pos, ind in enumerate(order):
+        if not objects[ind].empty():
+            name = 'obj_{:03d}.png'.format(len(order) - 1 - pos)
+            jobs.append((os.path.join(out_dir, name), objects[ind]))
+    if canvas is not None:
+        jobs.append((os.path.join(out_dir, 'composite.png'), canvas))
+    def write(filename, image):
+        # objects are placed in their frame on the pool too
+        if isinstance(image, Layer):
+            image = image.to_frame(bkg.shape)
+        return write_png(filename, image, compression)
+    executor = get_executor()
+    futures = [executor.submit(write, fn, image) for fn, image in jobs]
+    return [future.result() for future in futures]
+
+def load_material(filename, shape):
+    '''
+    Load an RGBA image to insert, centered in a frame of shape (H,W).
+    '''
+    return Layer.centered(np.array(Image.open(filename)), shape)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack decomposition directories into scene files.')
+    parser.add_argument('dirs', nargs='+', help='e.g. decomposition/image_1316')
+    args = parser.parse_args()
+    for file_dir in args.dirs:
+        print(pack_scene(file_dir))
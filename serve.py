@@ -0,0 +1,357 @@
+'''
+Local recomposition service, without Qt.
+
+    python serve.py --port 8600 --workers 4
+    python serve.py --unix /tmp/deocc.sock
+
+Scenes (every folder or packed scene of decomposition/ by default) are
+loaded once and stay in memory. Endpoints:
+
+    POST /render    body: one spec, as in recompose.py. Returns image/png,
+                    or raw RGBA rows (application/octet-stream, size in the
+                    X-Width and X-Height headers) with ?format=rgba
+    GET  /stats     latency percentiles, requests/s and batch sizes, JSON
+    GET  /scenes    resident scenes, JSON
+    GET  /materials resident materials, JSON
+
+The scene of a spec is the name of a resident scene, as listed by
+/scenes, or its path, and likewise for the materials to insert (every
+image of materials/ by default). Nothing else is read from disk, /render
+returns 404 for other scenes or materials.
+
+Requests for the same scene arriving within --batch-window ms of each other
+are rendered together by one worker, which reuses its compositor and the
+transform cache across the batch.
+'''
+import os
+import json
+import time
+import asyncio
+import argparse
+from glob import glob
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import scene
+import recompose
+from compositor import Compositor
+from layer import Layer, TransformCache
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+def scene_name(path):
+    '''
+    decomposition/image_1316, image_1316.scene -> image_1316
+    '''
+    return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+class Stats(object):
+    '''
+    Latencies of the last window requests, and their completion times for
+    the request rate.
+    '''
+
+    def __init__(self, window=10000, rate_window=10.):
+        self.latencies = deque(maxlen=window)
+        self.times = deque(maxlen=window)
+        self.rate_window = rate_window
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+
+    def add(self, latency, error=False):
+        self.latencies.append(latency)
+        self.times.append(time.time())
+        self.requests += 1
+        self.errors += error
+
+    def add_batch(self, size):
+        self.batches += 1
+        self.batched += size
+
+    def report(self):
+        now = time.time()
+        recent = sum(1 for t in self.times if now - t <= self.rate_window)
+        report = {'requests': self.requests, 'errors': self.errors,
+                  'uptime': now - self.start,
+                  'requests_per_s': recent / max(min(self.rate_window, now - self.start), 1e-9),
+                  'batches': self.batches,
+                  'mean_batch': self.batched / max(self.batches, 1)}
+        if self.latencies:
+            p50, p99 = np.percentile(np.array(self.latencies), [50, 99])
+            report.update({'p50_ms': p50 * 1e3, 'p99_ms': p99 * 1e3})
+        return report
+
+class RenderService(object):
+
+    def __init__(self, scene_paths, workers, interpolation='bicubic', compression=1,
+                 batch_window=2., max_batch=16, material_paths=()):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = TransformCache()
+        self.interpolation = interpolation
+        self.compression = compression
+        self.batch_window = batch_window / 1e3
+        self.max_batch = max_batch
+        self.stats = Stats()
+        # scene name -> (requests, timer) collected for the next batch
+        self.pending = {}
+        self.scenes = {}
+        # scene name -> path without extension, to check paths in specs
+        self.paths = {}
+        for path in scene_paths:
+            self.load(path)
+        # material name -> RGBA image, and path without extension
+        self.materials = {}
+        self.material_paths = {}
+        for path in material_paths:
+            name = scene_name(path)
+            self.materials[name] = scene.read_png(path)
+            self.material_paths[name] = os.path.splitext(os.path.abspath(path))[0]
+
+    def load(self, path):
+        '''
+        path: a decomposition folder or a packed scene
+        '''
+        name = scene_name(path)
+        self.scenes[name] = scene.load_scene(path)
+        self.paths[name] = os.path.splitext(os.path.abspath(os.path.normpath(path)))[0]
+
+    def resolve(self, path, paths=None):
+        '''
+        Name of the resident scene that path (a name, or a path to the
+        folder, packed scene or image) refers to, None if there is none.
+        paths: name -> path without extension, self.paths (scenes) by default
+        '''
+        if paths is None:
+            paths = self.paths
+        if not isinstance(path, str):
+            return None
+        name = scene_name(path)
+        if name not in paths:
+            return None
+        if os.path.dirname(os.path.normpath(path)) and \
+                os.path.splitext(os.path.abspath(os.path.normpath(path)))[0] != paths[name]:
+            return None
+        return name
+
+    def material(self, path, shape):
+        '''
+        A resident material centered in a frame of shape (H,W), cached by
+        recompose.get_material.
+        '''
+        name = self.resolve(path, self.material_paths)
+        if name is None:
+            raise LookupError('material {} is not resident'.format(path))
+        image = self.materials[name]
+        return recompose.get_material(self.material_paths[name], shape,
+                                      lambda _, shape: Layer.centered(image, shape))
+
+    async def render(self, name, spec, fmt):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = self.pending.get(name)
+        if entry is None:
+            timer = loop.call_later(self.batch_window, self.flush, name)
+            entry = self.pending[name] = ([], timer)
+        entry[0].append((spec, fmt, future))
+        if len(entry[0]) >= self.max_batch:
+            self.flush(name)
+        return await future
+
+    def flush(self, name):
+        requests, timer = self.pending.pop(name)
+        timer.cancel()
+        self.stats.add_batch(len(requests))
+        job = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.render_batch, name, [(spec, fmt) for spec, fmt, _ in requests])
+        def deliver(job):
+            futures = [future for _, _, future in requests]
+            if job.exception() is not None:
+                for future in futures:
+                    future.set_exception(job.exception())
+                return
+            for future, (ok, result) in zip(futures, job.result()):
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+        job.add_done_callback(deliver)
+
+    def render_batch(self, name, requests):
+        '''
+        Runs on a worker: one compositor for the whole batch.
+        '''
+        bkg, objects = self.scenes[name]
+        compositor = Compositor(bkg.shape[0], bkg.shape[1])
+        results = []
+        for spec, fmt in requests:
+            try:
+                canvas, _ = recompose.recompose(
+                    bkg, objects, spec, self.interpolation, self.cache, compositor=compositor,
+                    material=self.material)
+                results.append((True, self.encode(canvas, fmt)))
+            except Exception as e:
+                results.append((False, e))
+        return results
+
+    def encode(self, canvas, fmt):
+        '''
+        Returns (content type, body, extra headers).
+        '''
+        height, width = canvas.shape[:2]
+        if fmt == 'rgba':
+            body = cv2.cvtColor(canvas, cv2.COLOR_RGB2RGBA).tobytes()
+            return 'application/octet-stream', body, {'X-Width': width, 'X-Height': height}
+        if fmt != 'png':
+            raise ValueError('unknown format {}'.format(fmt))
+        ok, png = cv2.imencode('.png', canvas[:,:,::-1],
+                               [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+        return 'image/png', png.tobytes(), {}
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/render':
+            if method != 'POST':
+                return 405, 'application/json', b'{}', {}
+            start = time.perf_counter()
+            try:
+                spec = json.loads(body.decode('utf-8'))
+                fmt = parse_qs(url.query).get('format', [spec.get('format', 'png')])[0]
+                name = self.resolve(spec.get('scene'))
+                missing = [] if name is not None else ['scene {}'.format(spec.get('scene'))]
+                missing += ['material {}'.format(m['material']) for m in spec.get('insert') or []
+                            if self.resolve(m['material'], self.material_paths) is None]
+                if missing:
+                    self.stats.add(time.perf_counter() - start, error=True)
+                    return 404, 'application/json', json.dumps(
+                        {'error': '{} is not resident'.format(missing[0])}).encode('utf-8'), {}
+                content_type, payload, headers = await self.render(name, spec, fmt)
+            except Exception as e:
+                self.stats.add(time.perf_counter() - start, error=True)
+                return 400, 'application/json', json.dumps(
+                    {'error': '{}: {}'.format(type(e).__name__, e)}).encode('utf-8'), {}
+            self.stats.add(time.perf_counter() - start)
+            return 200, content_type, payload, headers
+        if url.path == '/stats':
+            return 200, 'application/json', json.dumps(self.stats.report()).encode('utf-8'), {}
+        if url.path == '/scenes':
+            scenes = {name: {'height': bkg.shape[0], 'width': bkg.shape[1],
+                             'objects': len(objects)}
+                      for name, (bkg, objects) in self.scenes.items()}
+            return 200, 'application/json', json.dumps(scenes).encode('utf-8'), {}
+        if url.path == '/materials':
+            materials = {name: {'height': image.shape[0], 'width': image.shape[1]}
+                         for name, image in self.materials.items()}
+            return 200, 'application/json', json.dumps(materials).encode('utf-8'), {}
+        return 404, 'application/json', b'{}', {}
+
+    async def handle(self, reader, writer):
+        '''
+        HTTP/1.1 with keep-alive, enough for local clients.
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, content_type, payload, extra = await self.dispatch(method, target, body)
+                except Exception as e:
+                    status, content_type, extra = 500, 'application/json', {}
+                    payload = json.dumps({'error': str(e)}).encode('utf-8')
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close')
+                head = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, '')),
+                        'Content-Type: {}'.format(content_type),
+                        'Content-Length: {}'.format(len(payload)),
+                        'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+                head += ['{}: {}'.format(k, v) for k, v in extra.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def report_loop(service, interval):
+    last = 0
+    while True:
+        await asyncio.sleep(interval)
+        if service.stats.requests == last:
+            continue
+        last = service.stats.requests
+        report = service.stats.report()
+        print('{requests} requests, {requests_per_s:.1f} req/s, p50 {p50_ms:.1f} ms, '
+              'p99 {p99_ms:.1f} ms, mean batch {mean_batch:.1f}'.format(**report), flush=True)
+
+async def serve(args):
+    paths = args.scenes
+    if not paths:
+        pattern = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decomposition', '*')
+        # packed scenes are preferred by find_scene
+        paths = [scene.find_scene(p) for p in sorted(set(
+            os.path.splitext(p)[0] for p in glob(pattern)
+            if os.path.isdir(p) or p.endswith(scene.PACKED_EXT)))]
+    materials = args.materials
+    if materials is None:
+        materials = sorted(glob(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'materials', '*.png')))
+    service = RenderService(paths, args.workers, args.interpolation, args.compression,
+                            args.batch_window, args.max_batch, materials)
+    if args.unix:
+        server = await asyncio.start_unix_server(service.handle, path=args.unix)
+        where = args.unix
+    else:
+        server = await asyncio.start_server(service.handle, args.host, args.port)
+        where = 'http://{}:{}'.format(args.host, args.port)
+    print('{} scenes and {} materials resident, serving on {}'.format(
+        len(service.scenes), len(service.materials), where), flush=True)
+    if args.report > 0:
+        asyncio.ensure_future(report_loop(service, args.report))
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recompositions over HTTP.')
+    parser.add_argument('scenes', nargs='*', help='scenes to keep resident, '
+                        'every one of decomposition/ by default')
+    parser.add_argument('--materials', nargs='*', help='materials that can be inserted, '
+                        'every image of materials/ by default')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--unix', help='listen on this Unix socket instead')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--interpolation', default='bicubic',
+                        choices=['nearest', 'bilinear', 'bicubic', 'lanczos'])
+    parser.add_argument('--compression', type=int, default=1, help='PNG compression level')
+    parser.add_argument('--batch-window', type=float, default=2.,
+                        help='ms to wait for more requests of the same scene')
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--report', type=float, default=10.,
+                        help='print the stats every this many seconds, 0 to disable')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
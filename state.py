@@ -0,0 +1,98 @@
+from collections import namedtuple
+
+# shift (x,y) in pixels, then resize by scale and rotate by degree around
+# the center of the object
+Transform = namedtuple('Transform', ['shift', 'scale', 'degree'])
+IDENTITY = Transform((0., 0.), 1., 0.)
+
+class SceneState(object):
+    '''
+    The transform of every object and the z-order (bottom first), over
+    immutable source layers. Rendered layers are derived from it, so reset
+    only swaps in the initial parameters. Every change is recorded as a
+    small delta that can be undone and redone.
+    '''
+
+    def __init__(self, sources, max_history=1000):
+        self.sources = tuple(sources)
+        self.transforms = (IDENTITY,) * len(self.sources)
+        self.order = tuple(range(len(self.sources)))
+        self.max_history = max_history
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def __len__(self):
+        return len(self.sources)
+
+    def set_transform(self, ind, transform, record=True, old=None):
+        '''
+        old: transform to record as the previous one, e.g. at the start of a
+        drag that was applied with record=False
+        '''
+        if old is None:
+            old = self.transforms[ind]
+        self.transforms = self.transforms[:ind] + (transform,) + self.transforms[ind + 1:]
+        if record and old != transform:
+            self.record(('transform', ind, old, transform))
+
+    def set_order(self, order):
+        order = tuple(int(i) for i in order)
+        if order != self.order:
+            self.record(('order', self.order, order))
+            self.order = order
+
+    def insert(self, layer):
+        self.record(('insert', layer))
+        self.apply(('insert', layer), False)
+
+    def reset(self):
+        '''
+        Every object back to IDENTITY, in the original order.
+        '''
+        delta = ('reset', self.transforms, self.order)
+        self.apply(delta, False)
+        self.record(delta)
+
+    def record(self, delta):
+        self.undo_stack.append(delta)
+        del self.undo_stack[: -self.max_history]
+        self.redo_stack = []
+
+    def undo(self):
+        if not self.undo_stack:
+            return False
+        delta = self.undo_stack.pop()
+        self.apply(delta, True)
+        self.redo_stack.append(delta)
+        return True
+
+    def redo(self):
+        if not self.redo_stack:
+            return False
+        delta = self.redo_stack.pop()
+        self.apply(delta, False)
+        self.undo_stack.append(delta)
+        return True
+
+    def apply(self, delta, backward):
+        kind = delta[0]
+        if kind == 'transform':
+            _, ind, old, new = delta
+            self.set_transform(ind, old if backward else new, record=False)
+        elif kind == 'order':
+            self.order = delta[1] if backward else delta[2]
+        elif kind == 'insert':
+            if backward:
+                self.sources = self.sources[:-1]
+                self.transforms = self.transforms[:-1]
+                self.order = tuple(i for i in self.order if i < len(self.sources))
+            else:
+                self.sources += (delta[1],)
+                self.transforms += (IDENTITY,)
+                self.order += (len(self.sources) - 1,)
+        elif kind == 'reset':
+            if backward:
+                self.transforms, self.order = delta[1], delta[2]
+            else:
+                self.transforms = (IDENTITY,) * len(self.sources)
+                self.order = tuple(range(len(self.sources)))
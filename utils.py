@@ -1,8 +1,5 @@
 import cv2
 import numpy as np
-from scipy import ndimage
-
-from PyQt5 import QtGui
 
 def bbox_iou(b1, b2):
     '''
@@ -20,6 +17,17 @@ def bbox_iou(b1, b2):
         a2 = float((b2[2] - b2[0]) * (b2[3] - b2[1]))
         return interArea / (a1 + a2 - interArea)
 
+def bbox_overlap_matrix(b1, b2):
+    '''
+    Whether every pair overlaps, b1: Nx4, b2: Mx4, (x,y,w,h). Returns NxM.
+    '''
+    b1 = np.asarray(b1, dtype=np.int64).reshape(-1, 4)[:, None]
+    b2 = np.asarray(b2, dtype=np.int64).reshape(-1, 4)[None]
+    return ((np.maximum(b1[..., 0], b2[..., 0]) <
+             np.minimum(b1[..., 0] + b1[..., 2], b2[..., 0] + b2[..., 2])) &
+            (np.maximum(b1[..., 1], b2[..., 1]) <
+             np.minimum(b1[..., 1] + b1[..., 3], b2[..., 1] + b2[..., 3])))
+
 def crop_padding(img, roi, pad_value):
     '''
     img: HxW or HxWxC np.ndarray
@@ -54,6 +62,8 @@ def resize_with_center(img, center, ratio):
     return newimg
 
 def rotate_with_center(img, center, degree):
+    # scipy takes longer to import than the rest of the app
+    from scipy import ndimage
     cx, cy = map(int, center)
     h, w, ch = img.shape
     bbox_centered = [0, 0, 2 * cx, 2 * cy]
@@ -62,6 +72,58 @@ def rotate_with_center(img, center, degree):
     bbox_recover = [0, 0, w, h]
     return crop_padding(img_r, bbox_recover, pad_value=tuple([0] * ch))
 
+INTERPOLATIONS = {
+    'nearest': cv2.INTER_NEAREST,
+    'bilinear': cv2.INTER_LINEAR,
+    'bicubic': cv2.INTER_CUBIC,
+    'lanczos': cv2.INTER_LANCZOS4,
+}
+
+def affine_matrix(shift, scale, degree, center):
+    '''
+    2x3 matrix that moves by shift, then resizes and rotates around center.
+    center is given after the move.
+    '''
+    matrix = cv2.getRotationMatrix2D((float(center[0]), float(center[1])), degree, scale)
+    matrix[:, 2] += matrix[:, :2].dot(np.array(shift, dtype=np.float64))
+    return matrix
+
+def transform_bbox(bbox, matrix):
+    '''
+    bbox: (x,y,w,h), returns the (x,y,w,h) covering its transformed corners
+    '''
+    x, y, w, h = bbox
+    corners = np.array([[x, y, 1], [x + w, y, 1], [x, y + h, 1], [x + w, y + h, 1]],
+                       dtype=np.float64)
+    pts = corners.dot(matrix.T)
+    x1, y1 = np.floor(pts.min(axis=0)).astype(int) - 1
+    x2, y2 = np.ceil(pts.max(axis=0)).astype(int) + 1
+    return [x1.item(), y1.item(), (x2 - x1).item(), (y2 - y1).item()]
+
+def warp_affine(img, matrix, dst_bbox, interpolation='bilinear'):
+    '''
+    img: HxWxC np.ndarray
+    matrix: 2x3, e.g. from affine_matrix
+    dst_bbox: (x,y,w,h) of the output in the destination space
+    Resamples once, only into dst_bbox.
+    '''
+    x, y, w, h = dst_bbox
+    matrix = matrix.copy()
+    matrix[:, 2] -= (x, y)
+    return cv2.warpAffine(
+        img, matrix, (w, h), flags=INTERPOLATIONS[interpolation],
+        borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def pyr_down(img, border=cv2.BORDER_REPLICATE):
+    '''
+    Halve img (HxWxC) with area averaging, padding the bottom and right to
+    an even size first.
+    '''
+    h, w = img.shape[:2]
+    if h % 2 or w % 2:
+        img = cv2.copyMakeBorder(img, 0, h % 2, 0, w % 2, border, value=0)
+    return cv2.resize(img, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+
 def mask_to_bbox(mask):
     mask = (mask == 1)
     if np.all(~mask):
@@ -73,6 +135,33 @@ def mask_to_bbox(mask):
     cmin, cmax = np.where(cols)[0][[0, -1]]
     return [cmin.item(), rmin.item(), cmax.item() + 1 - cmin.item(), rmax.item() + 1 - rmin.item()] # xywh
 
+def alpha_geometry(alpha, threshold=128):
+    '''
+    alpha: HxW uint8. Returns the bbox (x,y,w,h) of the non-zero pixels, the
+    center of the pixels over threshold as compute_center (the bbox origin
+    if there are none) and the number of non-zero pixels, from the row and
+    column maxima instead of boolean masks.
+    '''
+    if alpha.size == 0:
+        return [0, 0, 0, 0], [0, 0], 0
+    alpha = np.ascontiguousarray(alpha)
+    rows = alpha.max(axis=1)
+    cols = alpha.max(axis=0)
+    ys = np.flatnonzero(rows)
+    if len(ys) == 0:
+        return [0, 0, 0, 0], [0, 0], 0
+    xs = np.flatnonzero(cols)
+    x, y = int(xs[0]), int(ys[0])
+    bbox = [x, y, int(xs[-1]) + 1 - x, int(ys[-1]) + 1 - y]
+    ys = np.flatnonzero(rows > threshold)
+    xs = np.flatnonzero(cols > threshold)
+    if len(ys) == 0:
+        center = bbox[:2]
+    else:
+        x, y = int(xs[0]), int(ys[0])
+        center = [x + (int(xs[-1]) + 1 - x) // 2, y + (int(ys[-1]) + 1 - y) // 2]
+    return bbox, center, cv2.countNonZero(alpha)
+
 def compute_center(img):
     assert img.shape[2] == 4
     mask = img[:,:,3] > 128
@@ -80,3 +169,29 @@ def compute_center(img):
     center_x = bbox[0] + bbox[2] // 2
     center_y = bbox[1] + bbox[3] // 2
     return [center_x, center_y]
+
+def bbox_union(b1, b2):
+    '''
+    b: (x,y,w,h), empty bboxes are ignored
+    '''
+    if b1[2] <= 0 or b1[3] <= 0:
+        return list(b2)
+    if b2[2] <= 0 or b2[3] <= 0:
+        return list(b1)
+    x1 = min(b1[0], b2[0])
+    y1 = min(b1[1], b2[1])
+    x2 = max(b1[0] + b1[2], b2[0] + b2[2])
+    y2 = max(b1[1] + b1[3], b2[1] + b2[3])
+    return [x1, y1, x2 - x1, y2 - y1]
+
+def bbox_intersection(b1, b2):
+    '''
+    b: (x,y,w,h), returns [0,0,0,0] if they do not overlap
+    '''
+    x1 = max(b1[0], b2[0])
+    y1 = max(b1[1], b2[1])
+    x2 = min(b1[0] + b1[2], b2[0] + b2[2])
+    y2 = min(b1[1] + b1[3], b2[1] + b2[3])
+    if x2 <= x1 or y2 <= y1:
+        return [0, 0, 0, 0]
+    return [x1, y1, x2 - x1, y2 - y1]